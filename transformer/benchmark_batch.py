@@ -0,0 +1,124 @@
+import argparse
+import distutils.util
+import time
+import numpy as np
+
+from config import ModelHyperParams, encoder_input_data_names, \
+        decoder_input_data_names, label_data_names
+from data_util import pad_batch_data, prepare_batch_input
+
+parser = argparse.ArgumentParser(
+    "Micro-benchmark of building the padded mini-batch inputs.")
+parser.add_argument(
+    '--batch_sizes',
+    type=int,
+    nargs='+',
+    default=[8, 64, 512, 4096],
+    help='Batch sizes to benchmark. (default: %(default)s)')
+parser.add_argument(
+    '--max_len',
+    type=int,
+    default=32,
+    help='Max length of the random sequences. (default: %(default)d)')
+parser.add_argument(
+    '--repeat',
+    type=int,
+    default=10,
+    help='Number of runs for each batch size. (default: %(default)d)')
+parser.add_argument(
+    '--check',
+    type=distutils.util.strtobool,
+    default=True,
+    help='Whether check the outputs against the loop-based padding before '
+    'benchmarking. (default: %(default)d)')
+args = parser.parse_args()
+
+
+def random_batch(batch_size, max_len):
+    insts = []
+    for i in xrange(batch_size):
+        src_len, trg_len = np.random.randint(1, max_len + 1, size=2)
+        trg = np.random.randint(4, ModelHyperParams.trg_vocab_size,
+                                trg_len).tolist()
+        insts.append((np.random.randint(
+            4, ModelHyperParams.src_vocab_size, src_len).tolist(),
+                      [ModelHyperParams.bos_idx] + trg,
+                      trg + [ModelHyperParams.eos_idx]))
+    return insts
+
+
+def reference_pad_batch_data(insts, pad_idx, n_head, is_target=False):
+    """
+    The loop-based padding which pad_batch_data replaced, kept to check the
+    outputs. The positions of it are 0 for the words equal to pad_idx, while
+    pad_batch_data only sets 0 for the padding after the instances, which only
+    differ if pad_idx appears in the instances.
+    """
+    max_len = max(len(inst) for inst in insts)
+    inst_data = np.array(
+        [inst + [pad_idx] * (max_len - len(inst)) for inst in insts])
+    inst_pos = np.array([[
+        pos_i + 1 if w_i != pad_idx else 0 for pos_i, w_i in enumerate(inst)
+    ] for inst in inst_data])
+    if is_target:
+        slf_attn_bias_data = np.ones((inst_data.shape[0], max_len, max_len))
+        slf_attn_bias_data = np.triu(slf_attn_bias_data,
+                                     1).reshape([-1, 1, max_len, max_len])
+        slf_attn_bias_data = np.tile(slf_attn_bias_data,
+                                     [1, n_head, 1, 1]) * [-1e9]
+    else:
+        slf_attn_bias_data = np.array([[0] * len(inst) + [-1e9] *
+                                       (max_len - len(inst))
+                                       for inst in insts])
+        slf_attn_bias_data = np.tile(
+            slf_attn_bias_data.reshape([-1, 1, 1, max_len]),
+            [1, n_head, max_len, 1])
+    return [
+        inst_data.astype("int64").reshape([-1, 1]),
+        inst_pos.astype("int64").reshape([-1, 1]),
+        slf_attn_bias_data.astype("float32"), max_len
+    ]
+
+
+def check(insts):
+    """
+    Check pad_batch_data against the loop-based padding for the sources and
+    the targets, whose words never equal the pad indices.
+    """
+    for col, pad_idx, is_target in [(0, ModelHyperParams.src_pad_idx, False),
+                                    (1, ModelHyperParams.trg_pad_idx, True)]:
+        col_insts = [inst[col] for inst in insts]
+        outputs = pad_batch_data(col_insts, pad_idx, ModelHyperParams.n_head,
+                                 is_target)
+        expected = reference_pad_batch_data(
+            col_insts, pad_idx, ModelHyperParams.n_head, is_target)
+        for output, expected_output in zip(outputs, expected):
+            assert np.array_equal(output, expected_output), (
+                "pad_batch_data mismatches the loop-based padding.")
+            assert np.asarray(output).dtype == np.asarray(
+                expected_output).dtype
+
+
+def main():
+    input_data_names = encoder_input_data_names + \
+        decoder_input_data_names[:-1] + label_data_names
+    for batch_size in args.batch_sizes:
+        insts = random_batch(batch_size, args.max_len)
+        if args.check:
+            check(insts)
+        costs = []
+        for i in xrange(args.repeat):
+            start_time = time.time()
+            data_input = prepare_batch_input(
+                insts, input_data_names, ModelHyperParams.src_pad_idx,
+                ModelHyperParams.trg_pad_idx, ModelHyperParams.n_head,
+                ModelHyperParams.d_model)
+            costs.append(time.time() - start_time)
+        nbytes = sum(value.nbytes for value in data_input.values())
+        print("batch size: %d, min: %.3f ms, mean: %.3f ms, input size: %.1f MB"
+              % (batch_size, min(costs) * 1000, np.mean(costs) * 1000,
+                 nbytes / 1024. / 1024.))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+import os
+import json
+import time
+import Queue
+import shutil
+import threading
+import numpy as np
+
+import paddle.fluid as fluid
+
+# the prefix of the directory names of checkpoints, which are followed by the
+# training steps.
+CHECKPOINT_PREFIX = "checkpoint_"
+# the name of the file recording the training state in a checkpoint, which is
+# written last and thus marks a complete checkpoint.
+STATE_FILENAME = "state.json"
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class CheckpointManager(object):
+    """
+    Save and load the full training checkpoints under checkpoint_dir. A
+    checkpoint contains all the persistable variables of the program, i.e.
+    the parameters, the moments and beta power accumulators of Adam and the
+    learning rate, each saved as a .npy file, together with a JSON state of
+    the training progress, such as the steps of the learning rate scheduler
+    and the position of the training data. Only the latest keep_num
+    checkpoints are kept.
+
+    Saving copies the variables into host memory, which is all the training
+    loop waits for if max_pending is larger than 0. The copies are then
+    written by a background thread, and at most max_pending checkpoints are
+    waiting to be written, beyond which saving blocks until one is written.
+    The writer reports the latency and the bytes of every checkpoint.
+    """
+
+    _END = object()
+
+    def __init__(self, checkpoint_dir, keep_num=3, max_pending=0):
+        self.checkpoint_dir = checkpoint_dir
+        self.keep_num = keep_num
+        self.__error = None
+        self.__queue = None
+        if max_pending > 0:
+            self.__queue = Queue.Queue(maxsize=max_pending)
+            self.__thread = threading.Thread(target=self.__write_loop)
+            self.__thread.daemon = True
+            self.__thread.start()
+
+    def __path(self, step):
+        return os.path.join(self.checkpoint_dir,
+                            "%s%d" % (CHECKPOINT_PREFIX, step))
+
+    def steps(self):
+        """
+        The steps of the complete checkpoints in ascending order.
+        """
+        if not os.path.isdir(self.checkpoint_dir):
+            return []
+        steps = []
+        for name in os.listdir(self.checkpoint_dir):
+            step = name[len(CHECKPOINT_PREFIX):]
+            if name.startswith(CHECKPOINT_PREFIX) and step.isdigit() and (
+                    os.path.exists(
+                        os.path.join(self.checkpoint_dir, name,
+                                     STATE_FILENAME))):
+                steps.append(int(step))
+        return sorted(steps)
+
+    def __persistables(self, program, scope):
+        """
+        The persistable variables of a program, or a list of programs which
+        share the variables by names, such as the programs of accumulating and
+        applying gradients.
+        """
+        programs = program if isinstance(program, (list, tuple)) else [
+            program or fluid.framework.default_main_program()
+        ]
+        scope = scope or fluid.global_scope()
+        names = set()
+        for program in programs:
+            for var in program.list_vars():
+                if fluid.io.is_persistable(var) and var.name not in names and (
+                        scope.find_var(var.name) is not None):
+                    names.add(var.name)
+                    yield var.name, scope.find_var(var.name).get_tensor()
+
+    def save(self, exe, step, state, program=None, scope=None):
+        """
+        Save the persistable variables of program and the state as the
+        checkpoint of step, and remove the checkpoints beyond keep_num.
+        """
+        if self.__error is not None:
+            raise RuntimeError("Failed to write the checkpoint:\n%s" %
+                               self.__error)
+        start_time = time.time()
+        arrays = dict((name, np.array(tensor))
+                      for name, tensor in self.__persistables(program, scope))
+        snapshot_time = time.time() - start_time
+        if self.__queue is not None:
+            self.__queue.put((step, state, arrays, start_time, snapshot_time))
+        else:
+            self.__write(step, state, arrays, start_time, snapshot_time)
+
+    def __write_loop(self):
+        while True:
+            item = self.__queue.get()
+            try:
+                if item is CheckpointManager._END:
+                    return
+                if self.__error is None:
+                    self.__write(*item)
+            except Exception as e:
+                self.__error = "%s: %s" % (type(e).__name__, e)
+            finally:
+                self.__queue.task_done()
+
+    def __write(self, step, state, arrays, start_time, snapshot_time):
+        """
+        Write a checkpoint into a temporary directory, which is renamed when
+        all files are synced to the disk, thus an interrupted saving never
+        leaves a broken checkpoint.
+        """
+        path = self.__path(step)
+        tmp_path = path + ".tmp"
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        nbytes = 0
+        for name, array in arrays.iteritems():
+            with open(os.path.join(tmp_path, name + ".npy"), "wb") as f:
+                np.save(f, array)
+                f.flush()
+                os.fsync(f.fileno())
+                nbytes += f.tell()
+        with open(os.path.join(tmp_path, STATE_FILENAME), "w") as f:
+            json.dump(dict(state, step=step), f)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+        _fsync_dir(self.checkpoint_dir)
+
+        for old_step in self.steps()[:-self.keep_num]:
+            shutil.rmtree(self.__path(old_step))
+        print("checkpoint %d saved, size: %.1f MB, snapshot time: %.3f s, "
+              "latency: %.3f s" % (step, nbytes / 1024. / 1024.,
+                                   snapshot_time, time.time() - start_time))
+
+    def wait(self):
+        """
+        Wait until all the pending checkpoints are written.
+        """
+        if self.__queue is not None:
+            self.__queue.join()
+        if self.__error is not None:
+            raise RuntimeError("Failed to write the checkpoint:\n%s" %
+                               self.__error)
+
+    def close(self):
+        """
+        Write the pending checkpoints and stop the writer thread.
+        """
+        if self.__queue is not None:
+            self.__queue.put(CheckpointManager._END)
+            self.__thread.join()
+            self.__queue = None
+        self.wait()
+
+    def load(self, exe, program=None, step=None, scope=None):
+        """
+        Load the persistable variables of program from the checkpoint of step,
+        or from the latest checkpoint if step is None, and return the saved
+        state. None is returned if there is no checkpoint.
+        """
+        if step is None:
+            steps = self.steps()
+            if not steps:
+                return None
+            step = steps[-1]
+        path = self.__path(step)
+        for name, tensor in self.__persistables(program, scope):
+            var_path = os.path.join(path, name + ".npy")
+            if not os.path.exists(var_path):
+                raise IOError("The variable %s is missing in the checkpoint "
+                              "%s." % (name, path))
+            tensor.set(np.load(var_path), exe.place)
+        with open(os.path.join(path, STATE_FILENAME), "r") as f:
+            return json.load(f)
@@ -5,6 +5,38 @@ class TrainTaskConfig(object):
 
     # the number of sequences contained in a mini-batch.
     batch_size = 8  # there are memleak in Op::DataTransform. Need double buffer
+    # the flag indicating whether to pack mini-batches by a token budget
+    # rather than by a fixed number of sequences.
+    use_token_batch = False
+    # the max number of padded source or target tokens in a mini-batch, which
+    # is only used when use_token_batch is True.
+    max_tokens = 4096
+    # the number of instances buffered to be shuffled, which are also sorted
+    # by length and cut into mini-batches when use_token_batch is True.
+    pool_size = 100000
+    # the directory to cache the tokenized training corpus as memory-mapped
+    # binary files. The corpus is tokenized in every pass if it is None.
+    data_cache_dir = None
+    # the number of padded mini-batches prepared ahead of training by the
+    # prefetching threads. Mini-batches are prepared synchronously if it is 0.
+    prefetch_depth = 8
+    # the number of prefetching threads. The order of mini-batches is only
+    # kept with a single thread, thus it is forced to 1 when checkpoint_freq
+    # is larger than 0 or the training is resumed.
+    prefetch_thread_num = 1
+    # the number of worker processes preparing mini-batches, which are used
+    # instead of the prefetching threads if it is larger than 0.
+    prefetch_process_num = 0
+    # the flag indicating whether to keep the order of mini-batches prepared
+    # by the worker processes, which makes runs reproducible. It is forced to
+    # True when checkpoint_freq is larger than 0 or the training is resumed,
+    # since the checkpoints record the data position by the consumed batches.
+    prefetch_ordered = True
+
+    # the number of mini-batches whose gradients are accumulated for one
+    # update of the parameters, which multiplies the effective batch size
+    # without more memory. The learning rate is scheduled by updates.
+    accum_steps = 1
 
     # the hyper parameters for Adam optimizer.
     learning_rate = 0.001
@@ -12,14 +44,68 @@ class TrainTaskConfig(object):
     beta2 = 0.98
     eps = 1e-9
 
-    # the parameters for learning rate scheduling.
+    # the parameters for learning rate scheduling. The schedule is one of
+    # "noam", "linear" and "cosine", where the latter two decay to 0 at
+    # lr_total_steps from the peak learning_rate.
+    lr_schedule = "noam"
     warmup_steps = 4000
+    lr_total_steps = 100000
+
+    # the flag indicating whether to build the attention biases inside the
+    # program from the positions rather than feeding the dense biases.
+    attn_bias_in_graph = False
+    # the layout of the recordio files used by train_parallel_executor.py. The
+    # "compact" layout leaves out the dense attention biases, which are built
+    # inside the program, while the "full" layout stores all the fed data.
+    recordio_layout = "compact"
+    # the number of recordio files the training data is converted into.
+    recordio_part_num = 10
+    # the number of threads reading the recordio files.
+    reader_thread_num = 4
+    # the number of mini-batches buffered to be shuffled when reading the
+    # recordio files.
+    reader_shuffle_buffer_size = 100
+
+    # the number of CPU replicas training data-parallelly in
+    # train_parallel_executor.py when use_gpu is False. The environment
+    # variable CPU_NUM or the number of cores is used if it is 0.
+    cpu_num = 0
+    # the number of threads running the ops in train_parallel_executor.py.
+    # The default of ParallelExecutor is used if it is 0.
+    num_threads = 0
 
     # the flag indicating to use average loss or sum loss when training.
     use_avg_cost = False
 
+    # the number of steps between two reports of the training metrics, which
+    # are aggregated over the steps inside the program.
+    metrics_interval = 100
+    # the JSON lines file into which the per-phase timers and the throughput
+    # are written every metrics_interval steps. Nothing is timed if it is None.
+    metrics_file = None
+
+    # the held-out data file or directory evaluated every val_freq steps. It
+    # is tokenized, batched and padded once and kept in memory. No validation
+    # is run if it is None or val_freq is 0.
+    val_data = None
+    val_freq = 1000
+
     # the directory for saving trained models.
     model_dir = "trained_models"
+    # the number of steps between two full checkpoints, which are saved into
+    # model_dir/checkpoints and also at the end of every pass. No checkpoint
+    # is saved inside passes if it is 0.
+    checkpoint_freq = 1000
+    # the number of the latest checkpoints to keep.
+    checkpoint_keep_num = 3
+    # the max number of checkpoints copied into host memory and waiting to be
+    # written by the background writer thread. Checkpoints are written inside
+    # the training loop if it is 0.
+    checkpoint_max_pending = 2
+    # the flag indicating whether to resume the training from the latest
+    # checkpoint, including the optimizer states, the learning rate scheduler
+    # and the position of the training data.
+    resume = False
 
 
 class InferTaskConfig(object):
@@ -119,35 +205,60 @@ decoder_input_data_names = (
     "trg_src_attn_post_softmax_shape",
     "enc_output", )
 
+# Names of the attention bias data layers, which are not fed but built inside
+# the program from the positions when TrainTaskConfig.attn_bias_in_graph is
+# True.
+attn_bias_data_names = (
+    "src_slf_attn_bias",
+    "trg_slf_attn_bias",
+    "trg_src_attn_bias", )
+
 # Names of label related data layers listed in order.
 label_data_names = (
     "lbl_word",
     "lbl_weight", )
 
+# The shapes of the data fed to the model, in which the dimensions varying
+# with mini-batches, i.e. batch size and sequence lengths, are -1. The data of
+# words, positions and labels is in shape [batch_size * max_len_in_batch, 1].
 data_shapes = {
-    "src_word": (1 * (ModelHyperParams.max_length + 1), 1L),
-    "src_pos": (1 * (ModelHyperParams.max_length + 1), 1L),
-    "src_slf_attn_bias":
-    (1, ModelHyperParams.n_head, (ModelHyperParams.max_length + 1),
-     (ModelHyperParams.max_length + 1)),
+    "src_word": (-1, 1L),
+    "src_pos": (-1, 1L),
+    "src_slf_attn_bias": (-1, ModelHyperParams.n_head, -1, -1),
     "src_data_shape": (3L, ),
     "src_slf_attn_pre_softmax_shape": (2L, ),
     "src_slf_attn_post_softmax_shape": (4L, ),
-    "trg_word": (1 * (ModelHyperParams.max_length + 1), 1L),
-    "trg_pos": (1 * (ModelHyperParams.max_length + 1), 1L),
-    "trg_slf_attn_bias": (1, ModelHyperParams.n_head,
-                          (ModelHyperParams.max_length + 1),
-                          (ModelHyperParams.max_length + 1)),
-    "trg_src_attn_bias": (1, ModelHyperParams.n_head,
-                          (ModelHyperParams.max_length + 1),
-                          (ModelHyperParams.max_length + 1)),
+    "trg_word": (-1, 1L),
+    "trg_pos": (-1, 1L),
+    "trg_slf_attn_bias": (-1, ModelHyperParams.n_head, -1, -1),
+    "trg_src_attn_bias": (-1, ModelHyperParams.n_head, -1, -1),
     "trg_data_shape": (3L, ),
     "trg_slf_attn_pre_softmax_shape": (2L, ),
     "trg_slf_attn_post_softmax_shape": (4L, ),
     "trg_src_attn_pre_softmax_shape": (2L, ),
     "trg_src_attn_post_softmax_shape": (4L, ),
-    "enc_output":
-    (1, (ModelHyperParams.max_length + 1), ModelHyperParams.d_model),
-    "lbl_word": (1 * (ModelHyperParams.max_length + 1), 1L),
-    "lbl_weight": (1 * (ModelHyperParams.max_length + 1), 1L),
+    "enc_output": (-1, -1, ModelHyperParams.d_model),
+    "lbl_word": (-1, 1L),
+    "lbl_weight": (-1, 1L),
+}
+
+data_dtypes = {
+    "src_word": "int64",
+    "src_pos": "int64",
+    "src_slf_attn_bias": "float32",
+    "src_data_shape": "int32",
+    "src_slf_attn_pre_softmax_shape": "int32",
+    "src_slf_attn_post_softmax_shape": "int32",
+    "trg_word": "int64",
+    "trg_pos": "int64",
+    "trg_slf_attn_bias": "float32",
+    "trg_src_attn_bias": "float32",
+    "trg_data_shape": "int32",
+    "trg_slf_attn_pre_softmax_shape": "int32",
+    "trg_slf_attn_post_softmax_shape": "int32",
+    "trg_src_attn_pre_softmax_shape": "int32",
+    "trg_src_attn_post_softmax_shape": "int32",
+    "enc_output": "float32",
+    "lbl_word": "int64",
+    "lbl_weight": "float32",
 }
@@ -0,0 +1,657 @@
+import sys
+import time
+import Queue
+import random
+import threading
+import traceback
+import multiprocessing
+from collections import deque
+import numpy as np
+
+import paddle
+
+from config import TrainTaskConfig, attn_bias_data_names
+
+
+def pad_batch_data(insts,
+                   pad_idx,
+                   n_head,
+                   is_target=False,
+                   return_pos=True,
+                   return_attn_bias=True,
+                   return_max_len=True):
+    """
+    Pad the instances to the max sequence length in batch, and generate the
+    corresponding position data and attention bias. All the outputs are built
+    by preallocated arrays and broadcasting rather than Python loops.
+    """
+    return_list = []
+    inst_lens = np.array([len(inst) for inst in insts], dtype="int64")
+    max_len = int(inst_lens.max())
+    # The mask of non-padding words in shape [batch_size, max_len].
+    mask = np.arange(max_len) < inst_lens[:, np.newaxis]
+    inst_data = np.full(mask.shape, pad_idx, dtype="int64")
+    inst_data[mask] = np.concatenate(insts)
+    return_list += [inst_data.reshape([-1, 1])]
+    if return_pos:
+        # Only the padding after the instances takes the position 0, while the
+        # words equal to pad_idx inside the instances, if any, keep theirs.
+        inst_pos = np.arange(1, max_len + 1, dtype="int64") * mask
+        return_list += [inst_pos.reshape([-1, 1])]
+    if return_attn_bias:
+        slf_attn_bias_data = np.empty(
+            [len(insts), n_head, max_len, max_len], dtype="float32")
+        if is_target:
+            # This is used to avoid attention on paddings and subsequent
+            # words.
+            slf_attn_bias_data[:] = np.triu(
+                np.full([max_len, max_len], -1e9, dtype="float32"), 1)
+        else:
+            # This is used to avoid attention on paddings.
+            slf_attn_bias_data[:] = np.where(
+                mask, 0., -1e9).astype("float32")[:, np.newaxis, np.newaxis, :]
+        return_list += [slf_attn_bias_data]
+    if return_max_len:
+        return_list += [max_len]
+    return return_list if len(return_list) > 1 else return_list[0]
+
+
+def prepare_batch_input(insts, input_data_names, src_pad_idx, trg_pad_idx,
+                        n_head, d_model):
+    """
+    Put all padded data needed by training into a dict. The attention biases
+    are only generated if they are included in input_data_names.
+    """
+    return_attn_bias = any(name in input_data_names
+                           for name in attn_bias_data_names)
+    src_data = pad_batch_data(
+        [inst[0] for inst in insts],
+        src_pad_idx,
+        n_head,
+        is_target=False,
+        return_attn_bias=return_attn_bias)
+    trg_data = pad_batch_data(
+        [inst[1] for inst in insts],
+        trg_pad_idx,
+        n_head,
+        is_target=True,
+        return_attn_bias=return_attn_bias)
+    src_word, src_pos, src_max_len = src_data[0], src_data[1], src_data[-1]
+    trg_word, trg_pos, trg_max_len = trg_data[0], trg_data[1], trg_data[-1]
+    batch_size = len(insts)
+
+    # These shape tensors are used in reshape_op.
+    src_data_shape = np.array([batch_size, src_max_len, d_model], dtype="int32")
+    trg_data_shape = np.array([batch_size, trg_max_len, d_model], dtype="int32")
+    src_slf_attn_pre_softmax_shape = np.array([-1, src_max_len], dtype="int32")
+    src_slf_attn_post_softmax_shape = np.array(
+        [batch_size, n_head, src_max_len, src_max_len], dtype="int32")
+    trg_slf_attn_pre_softmax_shape = np.array([-1, trg_max_len], dtype="int32")
+    trg_slf_attn_post_softmax_shape = np.array(
+        [batch_size, n_head, trg_max_len, trg_max_len], dtype="int32")
+    trg_src_attn_pre_softmax_shape = np.array([-1, src_max_len], dtype="int32")
+    trg_src_attn_post_softmax_shape = np.array(
+        [batch_size, n_head, trg_max_len, src_max_len], dtype="int32")
+
+    lbl_word = pad_batch_data([inst[2] for inst in insts], trg_pad_idx, n_head,
+                              False, False, False, False)
+    lbl_weight = (lbl_word != trg_pad_idx).astype("float32").reshape([-1, 1])
+
+    data = {
+        "src_word": src_word,
+        "src_pos": src_pos,
+        "src_data_shape": src_data_shape,
+        "src_slf_attn_pre_softmax_shape": src_slf_attn_pre_softmax_shape,
+        "src_slf_attn_post_softmax_shape": src_slf_attn_post_softmax_shape,
+        "trg_word": trg_word,
+        "trg_pos": trg_pos,
+        "trg_data_shape": trg_data_shape,
+        "trg_slf_attn_pre_softmax_shape": trg_slf_attn_pre_softmax_shape,
+        "trg_slf_attn_post_softmax_shape": trg_slf_attn_post_softmax_shape,
+        "trg_src_attn_pre_softmax_shape": trg_src_attn_pre_softmax_shape,
+        "trg_src_attn_post_softmax_shape": trg_src_attn_post_softmax_shape,
+        "lbl_word": lbl_word,
+        "lbl_weight": lbl_weight
+    }
+    if return_attn_bias:
+        trg_src_attn_bias = np.empty(
+            [batch_size, n_head, trg_max_len, src_max_len], dtype="float32")
+        trg_src_attn_bias[:] = src_data[2][:, :, :1, :]
+        data["src_slf_attn_bias"] = src_data[2]
+        data["trg_slf_attn_bias"] = trg_data[2]
+        data["trg_src_attn_bias"] = trg_src_attn_bias
+
+    return dict((name, data[name]) for name in input_data_names)
+
+
+class BatchStats(object):
+    """
+    Accumulate the statistics of mini-batches, including tokens per batch and
+    the ratio of padding, which can be used to tune the batching configs.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.batch_num = 0
+        self.inst_num = 0
+        self.src_tokens = 0
+        self.src_padded_tokens = 0
+        self.trg_tokens = 0
+        self.trg_padded_tokens = 0
+
+    @staticmethod
+    def counts(batch):
+        """
+        The counts of a mini-batch, i.e. the number of instances and the real
+        and padded numbers of source and target tokens, which can be computed
+        where the mini-batch is prepared and passed around instead of it.
+        """
+        src_lens = [len(inst[0]) for inst in batch]
+        trg_lens = [len(inst[1]) for inst in batch]
+        return (len(batch), sum(src_lens), max(src_lens) * len(batch),
+                sum(trg_lens), max(trg_lens) * len(batch))
+
+    def update(self, batch):
+        self.add(BatchStats.counts(batch))
+
+    def add(self, counts):
+        inst_num, src_tokens, src_padded_tokens, trg_tokens, \
+            trg_padded_tokens = counts
+        self.batch_num += 1
+        self.inst_num += inst_num
+        self.src_tokens += src_tokens
+        self.src_padded_tokens += src_padded_tokens
+        self.trg_tokens += trg_tokens
+        self.trg_padded_tokens += trg_padded_tokens
+
+    def report(self):
+        batch_num = max(self.batch_num, 1)
+        return ("batches: %d, insts/batch: %.1f, src tokens/batch: %.1f, "
+                "trg tokens/batch: %.1f, src pad ratio: %.3f, "
+                "trg pad ratio: %.3f" %
+                (self.batch_num, float(self.inst_num) / batch_num,
+                 float(self.src_padded_tokens) / batch_num,
+                 float(self.trg_padded_tokens) / batch_num,
+                 1. - float(self.src_tokens) / max(self.src_padded_tokens, 1),
+                 1. - float(self.trg_tokens) / max(self.trg_padded_tokens, 1)))
+
+
+def _token_batches(pool, max_tokens, shuffle=True, rand=random):
+    """
+    Sort the instances of a pool by lengths and cut them into mini-batches by
+    the token budget, shuffling with the random generator rand.
+    """
+    if shuffle:
+        rand.shuffle(pool)
+    pool.sort(key=lambda inst: (len(inst[0]), len(inst[1])))
+    batches = []
+    batch, src_max_len, trg_max_len = [], 0, 0
+    for inst in pool:
+        src_len = max(src_max_len, len(inst[0]))
+        trg_len = max(trg_max_len, len(inst[1]))
+        if batch and (len(batch) + 1) * max(src_len, trg_len) > max_tokens:
+            batches.append(batch)
+            batch, src_len, trg_len = [], len(inst[0]), len(inst[1])
+        batch.append(inst)
+        src_max_len, trg_max_len = src_len, trg_len
+    if batch:
+        batches.append(batch)
+    if shuffle:
+        rand.shuffle(batches)
+    return batches
+
+
+def token_batch(reader, max_tokens, pool_size=10000, shuffle=True):
+    """
+    Create a batched reader which packs instances into mini-batches by a token
+    budget rather than by a fixed number of instances.
+
+    Instances are read into a pool of `pool_size`, sorted by lengths inside the
+    pool and then cut greedily into mini-batches, in which neither the padded
+    source tokens nor the padded target tokens exceed `max_tokens`. An instance
+    longer than `max_tokens` makes up a mini-batch by itself. If `shuffle` is
+    True, the instances are shuffled before sorting so that instances with the
+    same lengths are mixed, and the mini-batches in a pool are yielded in a
+    random order.
+    """
+
+    def batch_reader():
+        pool = []
+        for inst in reader():
+            pool.append(inst)
+            if len(pool) == pool_size:
+                for batch in _token_batches(pool, max_tokens, shuffle):
+                    yield batch
+                pool = []
+        if pool:
+            for batch in _token_batches(pool, max_tokens, shuffle):
+                yield batch
+
+    return batch_reader
+
+
+def train_batch_reader(reader, shuffle=True):
+    """
+    Batch the instance reader according to the batching configs in
+    TrainTaskConfig.
+    """
+    if TrainTaskConfig.use_token_batch:
+        return token_batch(reader, TrainTaskConfig.max_tokens,
+                           TrainTaskConfig.pool_size, shuffle)
+    if shuffle:
+        reader = paddle.reader.shuffle(
+            reader, buf_size=TrainTaskConfig.pool_size)
+    return paddle.batch(reader, batch_size=TrainTaskConfig.batch_size)
+
+
+class ResumableReader(object):
+    """
+    A batched training data reader whose position can be saved and restored.
+
+    The instances of a positioned reader (see nist_data_provider.train) are
+    read into pools of TrainTaskConfig.pool_size, which are shuffled by the
+    reader's own random generator and batched according to the batching
+    configs. The state of the reader is made up of the epoch, the position
+    where the current pool starts, the state of the random generator at the
+    start of the pool and the numbers of mini-batches consumed in the pool and
+    in the epoch. Thus a restored reader re-reads only the current pool and
+    skips the consumed mini-batches of it, yielding the same mini-batches as
+    an uninterrupted run.
+    """
+
+    def __init__(self, reader, shuffle=True, seed=None):
+        self.reader = reader
+        self.shuffle = shuffle
+        # The states at the starts of the pools read in the current epoch.
+        self.__pool_states = deque()
+        self.__start_state = {
+            "epoch": 0,
+            "position": None,
+            "rng_state": random.Random(seed).getstate(),
+            "pool_batch_id": 0,
+            "batch_id": 0
+        }
+
+    def __read_pools(self, position):
+        pool, pool_position = [], position
+        for position, inst in self.reader(position):
+            pool.append(inst)
+            if len(pool) == TrainTaskConfig.pool_size:
+                yield pool_position, pool
+                pool, pool_position = [], position
+        if pool:
+            yield pool_position, pool
+
+    def __split(self, pool, rand):
+        if TrainTaskConfig.use_token_batch:
+            return _token_batches(pool, TrainTaskConfig.max_tokens,
+                                  self.shuffle, rand)
+        if self.shuffle:
+            rand.shuffle(pool)
+        return [
+            pool[i:i + TrainTaskConfig.batch_size]
+            for i in xrange(0, len(pool), TrainTaskConfig.batch_size)
+        ]
+
+    def __call__(self):
+        state = self.__start_state
+        rng_state = state["rng_state"]
+        rand = random.Random()
+        # The state loaded from JSON is made of lists rather than tuples.
+        rand.setstate((rng_state[0], tuple(rng_state[1]), rng_state[2]))
+        skip_num = state["pool_batch_id"]
+        batch_id = state["batch_id"] - skip_num
+        self.__pool_states.clear()
+        for position, pool in self.__read_pools(state["position"]):
+            self.__pool_states.append({
+                "epoch": state["epoch"],
+                "position": position,
+                "rng_state": rand.getstate(),
+                "pool_batch_id": 0,
+                "batch_id": batch_id
+            })
+            batches = self.__split(pool, rand)
+            for batch in batches[skip_num:]:
+                yield batch
+            batch_id += len(batches)
+            skip_num = 0
+        self.__start_state = {
+            "epoch": state["epoch"] + 1,
+            "position": None,
+            "rng_state": rand.getstate(),
+            "pool_batch_id": 0,
+            "batch_id": 0
+        }
+
+    def state(self, batch_num=None):
+        """
+        Get the state after batch_num mini-batches of the current epoch are
+        consumed. The mini-batches are consumed in order, thus the states
+        before batch_num are dropped. If batch_num is None, get the state the
+        next call of the reader starts from, which is the start of the next
+        epoch once an epoch is read.
+        """
+        if batch_num is None or not self.__pool_states:
+            return dict(self.__start_state)
+        while len(self.__pool_states) > 1 and self.__pool_states[1][
+                "batch_id"] <= batch_num:
+            self.__pool_states.popleft()
+        pool_state = self.__pool_states[0]
+        return dict(
+            pool_state,
+            pool_batch_id=batch_num - pool_state["batch_id"],
+            batch_id=batch_num)
+
+    def set_state(self, state):
+        """
+        Set the state the next call of the reader starts from.
+        """
+        self.__start_state = dict(state)
+
+
+class Prefetcher(object):
+    """
+    Prefetch the data of a reader by producer threads, which read from the
+    reader, process the data by process_fn (e.g. padding the mini-batches into
+    feed dicts) and put the results into a bounded queue of queue_depth ahead
+    of the consumer.
+
+    Calling the prefetcher returns a generator of one pass. The producers are
+    shut down when the generator is exhausted or closed. The order of the
+    results is only kept with a single producer thread. The time the consumer
+    has waited on the queue in the latest pass is recorded in wait_time, and
+    the number of times it found the queue empty and blocked in wait_count.
+    """
+
+    _END = object()
+
+    class _Error(object):
+        def __init__(self, exc_info):
+            self.exc_info = exc_info
+
+    def __init__(self, reader, process_fn=None, queue_depth=8, thread_num=1):
+        self.reader = reader
+        self.process_fn = process_fn
+        self.queue_depth = queue_depth
+        self.thread_num = thread_num
+        self.wait_time = 0.
+        self.wait_count = 0
+
+    def __call__(self):
+        queue = Queue.Queue(maxsize=self.queue_depth)
+        stop_event = threading.Event()
+        read_lock = threading.Lock()
+        data_iter = self.reader()
+
+        def __put(item):
+            while not stop_event.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return
+                except Queue.Full:
+                    continue
+
+        def __produce():
+            try:
+                while not stop_event.is_set():
+                    with read_lock:
+                        try:
+                            data = next(data_iter)
+                        except StopIteration:
+                            break
+                    __put(self.process_fn(data) if self.process_fn else data)
+            except Exception:
+                __put(Prefetcher._Error(sys.exc_info()))
+            finally:
+                __put(Prefetcher._END)
+
+        threads = [
+            threading.Thread(target=__produce) for i in xrange(self.thread_num)
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        self.wait_time = 0.
+        self.wait_count = 0
+        finished_num = 0
+        try:
+            while finished_num < self.thread_num:
+                try:
+                    item = queue.get_nowait()
+                except Queue.Empty:
+                    start_time = time.time()
+                    item = queue.get()
+                    self.wait_time += time.time() - start_time
+                    self.wait_count += 1
+                if item is Prefetcher._END:
+                    finished_num += 1
+                elif isinstance(item, Prefetcher._Error):
+                    # Re-raise with the traceback of the producer.
+                    raise item.exc_info[0], item.exc_info[1], item.exc_info[2]
+                else:
+                    yield item
+        finally:
+            stop_event.set()
+            for thread in threads:
+                thread.join()
+
+
+class _SharedArray(object):
+    """
+    The placeholder of an array which is written into a shared memory slot.
+    """
+
+    def __init__(self, offset, dtype, shape):
+        self.offset = offset
+        self.dtype = dtype
+        self.shape = shape
+
+
+class MultiProcessPrefetcher(object):
+    """
+    Prefetch the data of a reader by worker processes, which process the data
+    by process_fn (e.g. padding the mini-batches into feed dicts) to bypass the
+    GIL. The NumPy arrays in the results, which can be nested in tuples and
+    dicts, are sent back through shared memory slots of slot_size bytes
+    instead of being pickled, while results exceeding a slot are pickled and
+    counted in pickled_num. Other objects in the results are pickled, thus
+    process_fn should return small summaries rather than the raw mini-batches.
+
+    If ordered is True, the results are yielded in the order of the reader
+    regardless of which worker finishes first, thus runs are reproducible. At
+    most queue_depth mini-batches are in flight. The time the consumer has
+    waited for the results in the latest pass is recorded in wait_time, and
+    the number of times it blocked in wait_count.
+    """
+
+    _END = "end"
+    _ERROR = "error"
+    _ALIGNMENT = 64
+
+    def __init__(self,
+                 reader,
+                 process_fn,
+                 worker_num=4,
+                 queue_depth=16,
+                 ordered=True,
+                 slot_size=32 << 20):
+        self.reader = reader
+        self.process_fn = process_fn
+        self.worker_num = worker_num
+        self.queue_depth = max(queue_depth, worker_num)
+        self.ordered = ordered
+        self.slot_size = slot_size
+        self.slots = [
+            multiprocessing.RawArray("b", slot_size)
+            for i in xrange(worker_num * 2)
+        ]
+        self.wait_time = 0.
+        self.wait_count = 0
+        self.pickled_num = 0
+
+    def __pack(self, result, slot, offset=None):
+        """
+        Write the arrays in result into the slot and replace them with
+        _SharedArray placeholders. Return None if the slot is too small.
+        """
+        offset = offset if offset is not None else [0]
+        if isinstance(result, np.ndarray):
+            start = offset[0]
+            end = start + result.nbytes
+            if end > self.slot_size:
+                return None
+            np.frombuffer(
+                slot, dtype=result.dtype, count=result.size,
+                offset=start)[:] = result.ravel()
+            offset[0] = (end + self._ALIGNMENT - 1) // self._ALIGNMENT * \
+                self._ALIGNMENT
+            return _SharedArray(start, result.dtype.str, result.shape)
+        elif isinstance(result, dict):
+            packed = {}
+            for key, value in result.iteritems():
+                packed[key] = self.__pack(value, slot, offset)
+                if packed[key] is None and value is not None:
+                    return None
+            return packed
+        elif isinstance(result, tuple):
+            packed = tuple(self.__pack(value, slot, offset) for value in result)
+            if any(p is None and v is not None
+                   for p, v in zip(packed, result)):
+                return None
+            return packed
+        return result
+
+    def __unpack(self, packed, slot):
+        if isinstance(packed, _SharedArray):
+            dtype = np.dtype(packed.dtype)
+            return np.frombuffer(
+                slot,
+                dtype=dtype,
+                count=int(np.prod(packed.shape)),
+                offset=packed.offset).reshape(packed.shape).copy()
+        elif isinstance(packed, dict):
+            return dict((key, self.__unpack(value, slot))
+                        for key, value in packed.iteritems())
+        elif isinstance(packed, tuple):
+            return tuple(self.__unpack(value, slot) for value in packed)
+        return packed
+
+    def __work(self, task_queue, result_queue, free_slots):
+        while True:
+            task = task_queue.get()
+            if task is None:
+                result_queue.put((self._END, None, None))
+                break
+            seq_id, data = task
+            try:
+                result = self.process_fn(data)
+            except Exception:
+                result_queue.put((self._ERROR, None, traceback.format_exc()))
+                break
+            slot_id = free_slots.get()
+            packed = self.__pack(result, self.slots[slot_id])
+            if packed is None:
+                free_slots.put(slot_id)
+                result_queue.put((seq_id, None, result))
+            else:
+                result_queue.put((seq_id, slot_id, packed))
+
+    def __call__(self):
+        task_queue = multiprocessing.Queue()
+        result_queue = multiprocessing.Queue()
+        free_slots = multiprocessing.Queue()
+        for slot_id in xrange(len(self.slots)):
+            free_slots.put(slot_id)
+        workers = [
+            multiprocessing.Process(
+                target=self.__work,
+                args=(task_queue, result_queue, free_slots))
+            for i in xrange(self.worker_num)
+        ]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        # The tokens bound the number of mini-batches in flight.
+        tokens = Queue.Queue()
+        for i in xrange(self.queue_depth):
+            tokens.put(None)
+        stop_event = threading.Event()
+        feed_error = []
+
+        def __feed():
+            try:
+                for seq_id, data in enumerate(self.reader()):
+                    while not stop_event.is_set():
+                        try:
+                            tokens.get(timeout=0.1)
+                            break
+                        except Queue.Empty:
+                            continue
+                    if stop_event.is_set():
+                        return
+                    task_queue.put((seq_id, data))
+            except Exception:
+                feed_error.append(traceback.format_exc())
+            finally:
+                for worker in workers:
+                    task_queue.put(None)
+
+        feeder = threading.Thread(target=__feed)
+        feeder.daemon = True
+        feeder.start()
+
+        self.wait_time = 0.
+        self.wait_count = 0
+        self.pickled_num = 0
+        pending = {}
+        next_seq_id = 0
+        finished_num = 0
+        try:
+            while finished_num < self.worker_num or pending:
+                if self.ordered and next_seq_id in pending:
+                    result = pending.pop(next_seq_id)
+                elif finished_num == self.worker_num:
+                    # Only happens if a mini-batch is lost, which is a bug.
+                    raise RuntimeError("Missing mini-batch %d." % next_seq_id)
+                else:
+                    try:
+                        seq_id, slot_id, packed = result_queue.get_nowait()
+                    except Queue.Empty:
+                        start_time = time.time()
+                        seq_id, slot_id, packed = result_queue.get()
+                        self.wait_time += time.time() - start_time
+                        self.wait_count += 1
+                    if seq_id == self._END:
+                        finished_num += 1
+                        continue
+                    elif seq_id == self._ERROR:
+                        raise RuntimeError(
+                            "Error in the prefetching worker:\n" + packed)
+                    if slot_id is not None:
+                        packed = self.__unpack(packed, self.slots[slot_id])
+                        free_slots.put(slot_id)
+                    else:
+                        self.pickled_num += 1
+                        if self.pickled_num == 1:
+                            print("a prefetched result exceeds the shared "
+                                  "memory slot of %d bytes and is pickled" %
+                                  self.slot_size)
+                    if self.ordered and seq_id != next_seq_id:
+                        pending[seq_id] = packed
+                        continue
+                    result = packed
+                next_seq_id += 1
+                tokens.put(None)
+                yield result
+            if feed_error:
+                raise RuntimeError("Error in reading data:\n" + feed_error[0])
+        finally:
+            stop_event.set()
+            for worker in workers:
+                worker.terminate()
+                worker.join()
+            feeder.join()
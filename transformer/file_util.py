@@ -0,0 +1,37 @@
+import os
+import shutil
+import hashlib
+
+# the number of bytes read from a file at a time when hashing it.
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def file_md5(file_path):
+    md5 = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), ""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def __remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def write_atomically(path, write_fn):
+    """
+    Write a file or a directory at path by write_fn, which is given a
+    temporary path to write and is renamed to path when done, thus an
+    interrupted writing never leaves a half-written file. The temporary path is
+    removed if writing or renaming fails, and the error is raised.
+    """
+    tmp_path = "%s.tmp%d" % (path, os.getpid())
+    try:
+        write_fn(tmp_path)
+        os.rename(tmp_path, path)
+    except:
+        __remove(tmp_path)
+        raise
@@ -8,7 +8,7 @@ from model import wrap_encoder as encoder
 from model import wrap_decoder as decoder
 from config import InferTaskConfig, ModelHyperParams, \
         encoder_input_data_names, decoder_input_data_names
-from train import pad_batch_data
+from data_util import pad_batch_data
 import nist_data_provider
 
 
@@ -0,0 +1,268 @@
+import json
+import time
+import threading
+from collections import defaultdict
+import numpy as np
+
+import paddle.fluid as fluid
+import paddle.fluid.layers as layers
+
+from data_util import BatchStats
+
+
+class TrainMetrics(object):
+    """
+    Aggregate the training metrics over the steps between two reports, which
+    are made every interval steps.
+
+    The loss and the number of tokens, and optionally the data shape whose
+    first element is the batch size, are accumulated inside the program into
+    persistable float64 totals. Only the totals are fetched and only on the
+    reporting steps, thus the other steps run without any fetching. The
+    totals are never reset, and the differences between two reports make the
+    aggregated loss, perplexity, tokens/sec and step time. The fetched totals
+    of multiple devices are summed.
+    """
+
+    # The names and formats of the reported metrics.
+    FORMATS = (("sum loss", "%f"), ("avg loss", "%f"), ("ppl", "%f"),
+               ("tokens/sec", "%.1f"), ("step time", "%.4f"),
+               ("samples/sec", "%.2f"))
+
+    def __init__(self, sum_cost, token_num, interval=100, data_shape=None):
+        self.interval = interval
+        with fluid.program_guard(sum_cost.block.program):
+            self.totals = [
+                self.__accumulate(sum_cost, "@METRIC_LOSS_SUM@"),
+                self.__accumulate(token_num, "@METRIC_TOKEN_SUM@")
+            ]
+            if data_shape is not None:
+                self.totals.append(
+                    self.__accumulate(data_shape, "@METRIC_DATA_SHAPE_SUM@"))
+        self.reset()
+
+    def __accumulate(self, var, name):
+        total = layers.create_global_var(
+            name=name,
+            shape=var.shape,
+            value=0.,
+            dtype="float64",
+            persistable=True)
+        layers.sums(input=[total, layers.cast(var, "float64")], out=total)
+        return total
+
+    def reset(self, step=0, scope=None):
+        """
+        Start aggregating from step with the totals in scope, which should be
+        called after the totals are initialized or loaded.
+        """
+        scope = scope or fluid.global_scope()
+        self.last_values = [
+            np.array(scope.find_var(total.name).get_tensor())
+            if scope.find_var(total.name) is not None else np.zeros(
+                total.shape, dtype="float64") for total in self.totals
+        ]
+        self.last_step = step
+        self.last_time = time.time()
+
+    def should_fetch(self, step):
+        return self.interval > 0 and step % self.interval == 0
+
+    def fetch_list(self):
+        return self.totals
+
+    def compute(self, step, outs):
+        """
+        Compute the metrics aggregated up to step from the fetched totals as a
+        dict keyed by the names of metrics.
+        """
+        values = [
+            np.array(out).reshape([-1, int(np.prod(total.shape))]).sum(axis=0)
+            for out, total in zip(outs, self.totals)
+        ]
+        loss, tokens = [float(value[0] - last_value[0])
+                        for value, last_value in zip(values[:2],
+                                                     self.last_values[:2])]
+        step_num = max(step - self.last_step, 1)
+        elapsed_time = max(time.time() - self.last_time, 1e-6)
+        avg_loss = loss / max(tokens, 1.)
+        result = {
+            "sum loss": loss / step_num,
+            "avg loss": avg_loss,
+            "ppl": float(np.exp(min(avg_loss, 100))),
+            "tokens/sec": tokens / elapsed_time,
+            "step time": elapsed_time / step_num
+        }
+        if len(values) > 2:
+            result["samples/sec"] = float(
+                values[2][0] - self.last_values[2][0]) / elapsed_time
+        self.last_values = values
+        self.last_step = step
+        self.last_time = time.time()
+        return result
+
+    def report(self, step, outs, result=None):
+        """
+        Format the metrics aggregated up to step, which are computed from the
+        fetched totals unless the computed result is given.
+        """
+        result = result or self.compute(step, outs)
+        return ", ".join("%s: %s" % (name, fmt % result[name])
+                         for name, fmt in self.FORMATS if name in result)
+
+
+class Instrumentation(object):
+    """
+    Per-phase wall-clock timers and throughput statistics of training, which
+    are written as JSON lines into the metrics file at path every interval
+    steps. Each line holds the average seconds per step of every phase, the
+    step time, the source and target tokens per second, the padding fractions
+    and other values given at the step, e.g. the aggregated loss.
+
+    Phases are timed by `with instrumentation.phase(name)`, iterators by
+    timed() and functions run by other threads by timed_fn(). With the
+    prefetchers, the time to read a mini-batch is the time waiting on the
+    queue, and the time to prepare mini-batches overlaps with the other
+    phases, which is not recorded with the worker processes. Without them,
+    preparing is timed as part of reading. If path is None, the
+    instrumentation is disabled and does nothing.
+    """
+
+    class _Timer(object):
+        def __init__(self, times, name):
+            self.times = times
+            self.name = name
+            self.start_time = 0.
+
+        def __enter__(self):
+            self.start_time = time.time()
+
+        def __exit__(self, *args):
+            self.times[self.name] += time.time() - self.start_time
+
+    class _NullTimer(object):
+        def __enter__(self):
+            pass
+
+        def __exit__(self, *args):
+            pass
+
+    def __init__(self, path=None, interval=100):
+        self.enabled = path is not None
+        self.interval = interval
+        self.__null_timer = Instrumentation._NullTimer()
+        if not self.enabled:
+            return
+        self.__file = open(path, "a")
+        self.__lock = threading.Lock()
+        self.__times = defaultdict(float)
+        self.__timers = {}
+        self.__batch_stats = BatchStats()
+        self.__last_step = None
+        self.__last_time = time.time()
+
+    def phase(self, name):
+        if not self.enabled:
+            return self.__null_timer
+        timer = self.__timers.get(name)
+        if timer is None:
+            timer = self.__timers[name] = Instrumentation._Timer(
+                self.__times, name)
+        return timer
+
+    def timed(self, iterable, name):
+        """
+        Time getting every item from iterable as the phase name.
+        """
+        if not self.enabled:
+            return iterable
+
+        def __timed():
+            timer = self.phase(name)
+            iterator = iter(iterable)
+            while True:
+                with timer:
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        return
+                yield item
+
+        return __timed()
+
+    def timed_fn(self, fn, name):
+        """
+        Time the calls of fn as the phase name, which can be made by multiple
+        threads.
+        """
+        if not self.enabled:
+            return fn
+
+        def __timed_fn(*args, **kwargs):
+            start_time = time.time()
+            result = fn(*args, **kwargs)
+            with self.__lock:
+                self.__times[name] += time.time() - start_time
+            return result
+
+        return __timed_fn
+
+    def step(self, step, batch_counts=None, **values):
+        """
+        Record a step with the BatchStats.counts of its mini-batch if known,
+        and write the statistics since the last written step if step is a
+        multiple of interval. The values are also written in the line.
+        """
+        if not self.enabled:
+            return
+        if batch_counts is not None:
+            self.__batch_stats.add(batch_counts)
+        if self.__last_step is None:
+            self.__last_step = step - 1
+        if step % self.interval != 0:
+            return
+
+        now = time.time()
+        step_num = max(step - self.__last_step, 1)
+        elapsed_time = max(now - self.__last_time, 1e-6)
+        with self.__lock:
+            phases = dict((name, seconds / step_num)
+                          for name, seconds in self.__times.iteritems())
+            self.__times.clear()
+        record = {
+            "step": step,
+            "time": now,
+            "step time": elapsed_time / step_num,
+            "phases": phases
+        }
+        stats = self.__batch_stats
+        if stats.batch_num > 0:
+            record.update({
+                "src tokens/sec": stats.src_tokens / elapsed_time,
+                "trg tokens/sec": stats.trg_tokens / elapsed_time,
+                "src pad fraction":
+                1. - float(stats.src_tokens) / max(stats.src_padded_tokens, 1),
+                "trg pad fraction":
+                1. - float(stats.trg_tokens) / max(stats.trg_padded_tokens, 1)
+            })
+        record.update(values)
+        self.__file.write(json.dumps(record, sort_keys=True) + "\n")
+        self.__file.flush()
+        stats.reset()
+        self.__last_step = step
+        self.__last_time = now
+
+    def log(self, step, **values):
+        """
+        Write the values at step as a line immediately, e.g. the validation
+        results.
+        """
+        if not self.enabled:
+            return
+        values.update(step=step, time=time.time())
+        self.__file.write(json.dumps(values, sort_keys=True) + "\n")
+        self.__file.flush()
+
+    def close(self):
+        if self.enabled:
+            self.__file.close()
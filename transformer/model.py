@@ -5,7 +5,8 @@ import paddle.fluid as fluid
 import paddle.fluid.layers as layers
 
 from config import TrainTaskConfig, pos_enc_param_names, \
-    encoder_input_data_names, decoder_input_data_names, label_data_names
+    encoder_input_data_names, decoder_input_data_names, label_data_names, \
+    attn_bias_data_names
 
 
 def position_encoding_init(n_position, d_pos_vec):
@@ -507,6 +508,52 @@ def make_inputs(input_data_names,
     return input_layers
 
 
+def make_attn_bias(q_pos,
+                   k_pos,
+                   q_pre_softmax_shape,
+                   k_pre_softmax_shape,
+                   n_head,
+                   max_length,
+                   is_causal=False):
+    """
+    Build the attention bias inside the program from the positions of queries
+    and keys, which are in shape [batch_size * max_len_in_batch, 1] and have
+    the value 0 on paddings. Only the positions and the small shape tensors
+    are needed to be fed rather than the dense attention bias.
+
+    The bias avoids attention on the paddings of keys, and also on subsequent
+    words if is_causal is True. It is built in shape [batch_size, 1, q_len,
+    k_len] by broadcasting through matmul and then expanded across heads into
+    [batch_size, n_head, q_len, k_len].
+    """
+
+    def __reshape_pos(pos, pre_softmax_shape, shape):
+        # pre_softmax_shape is [-1, max_len_in_batch] for self attention.
+        pos = layers.reshape(
+            x=layers.cast(
+                x=pos, dtype="float32"),
+            shape=[-1, max_length],
+            actual_shape=pre_softmax_shape)
+        # The value 0 in shape attr means copying the corresponding dimension
+        # size of the input as the output dimension size.
+        return layers.reshape(x=pos, shape=shape)
+
+    q = __reshape_pos(q_pos, q_pre_softmax_shape, [0, 1, -1, 1])
+    k = __reshape_pos(k_pos, k_pre_softmax_shape, [0, 1, 1, -1])
+    q_ones = layers.scale(x=q, scale=0.) + 1.
+    # The mask of keys is 1 for words and 0 for paddings, thus the bias is
+    # -1e9 on paddings and 0 on words.
+    k_mask = layers.clip(x=k, min=0., max=1.)
+    attn_bias = layers.matmul(q_ones, (k_mask - 1.) * 1e9)
+    if is_causal:
+        k_ones = layers.scale(x=k, scale=0.) + 1.
+        # The difference of positions is positive for subsequent words.
+        pos_diff = layers.matmul(q_ones, k) - layers.matmul(q, k_ones)
+        attn_bias = attn_bias + layers.clip(
+            x=pos_diff, min=0., max=1.) * -1e9
+    return layers.expand(x=attn_bias, expand_times=[1, n_head, 1, 1])
+
+
 def transformer(
         src_vocab_size,
         trg_vocab_size,
@@ -520,19 +567,34 @@ def transformer(
         dropout_rate,
         src_pad_idx,
         trg_pad_idx,
-        pos_pad_idx, ):
+        pos_pad_idx,
+        attn_bias_in_graph=False, ):
+    """
+    Build the transformer model for training. If attn_bias_in_graph is True,
+    the attention biases are built inside the program from the positions and
+    are not included in the data layers.
+    """
     enc_inputs = make_inputs(
-        encoder_input_data_names,
+        filter(lambda name: name not in attn_bias_data_names,
+               encoder_input_data_names)
+        if attn_bias_in_graph else encoder_input_data_names,
         n_head,
         d_model,
         max_length,
         is_pos=True,
-        slf_attn_bias_flag=True,
+        slf_attn_bias_flag=not attn_bias_in_graph,
         src_attn_bias_flag=False,
         enc_output_flag=False,
         data_shape_flag=True,
         slf_attn_shape_flag=True,
         src_attn_shape_flag=False)
+    if attn_bias_in_graph:
+        src_pos, src_slf_attn_pre_softmax_shape = enc_inputs[1], enc_inputs[3]
+        enc_inputs.insert(2,
+                          make_attn_bias(src_pos, src_pos,
+                                         src_slf_attn_pre_softmax_shape,
+                                         src_slf_attn_pre_softmax_shape,
+                                         n_head, max_length))
     enc_output = wrap_encoder(
         src_vocab_size,
         max_length,
@@ -548,17 +610,33 @@ def transformer(
         enc_inputs, )
 
     dec_inputs = make_inputs(
-        decoder_input_data_names,
+        filter(lambda name: name not in attn_bias_data_names,
+               decoder_input_data_names)
+        if attn_bias_in_graph else decoder_input_data_names,
         n_head,
         d_model,
         max_length,
         is_pos=True,
-        slf_attn_bias_flag=True,
-        src_attn_bias_flag=True,
+        slf_attn_bias_flag=not attn_bias_in_graph,
+        src_attn_bias_flag=not attn_bias_in_graph,
         enc_output_flag=False,
         data_shape_flag=True,
         slf_attn_shape_flag=True,
         src_attn_shape_flag=True)
+    if attn_bias_in_graph:
+        trg_pos, trg_slf_attn_pre_softmax_shape = dec_inputs[1], dec_inputs[3]
+        trg_slf_attn_bias = make_attn_bias(
+            trg_pos,
+            trg_pos,
+            trg_slf_attn_pre_softmax_shape,
+            trg_slf_attn_pre_softmax_shape,
+            n_head,
+            max_length,
+            is_causal=True)
+        trg_src_attn_bias = make_attn_bias(
+            trg_pos, src_pos, trg_slf_attn_pre_softmax_shape,
+            src_slf_attn_pre_softmax_shape, n_head, max_length)
+        dec_inputs[2:2] = [trg_slf_attn_bias, trg_src_attn_bias]
     predict = wrap_decoder(
         trg_vocab_size,
         max_length,
@@ -647,6 +725,29 @@ def transformer_pe(
         src_pad_idx,
         trg_pad_idx,
         pos_pad_idx, ):
+    if attn_bias_data_names[0] not in field_map:
+        # The recordio files in compact layout leave out the attention biases,
+        # which are built from the positions here.
+        field_map = dict(field_map)
+        src_pos, trg_pos = field_map["src_pos"], field_map["trg_pos"]
+        src_slf_attn_pre_softmax_shape = field_map[
+            "src_slf_attn_pre_softmax_shape"]
+        trg_slf_attn_pre_softmax_shape = field_map[
+            "trg_slf_attn_pre_softmax_shape"]
+        field_map["src_slf_attn_bias"] = make_attn_bias(
+            src_pos, src_pos, src_slf_attn_pre_softmax_shape,
+            src_slf_attn_pre_softmax_shape, n_head, max_length)
+        field_map["trg_slf_attn_bias"] = make_attn_bias(
+            trg_pos,
+            trg_pos,
+            trg_slf_attn_pre_softmax_shape,
+            trg_slf_attn_pre_softmax_shape,
+            n_head,
+            max_length,
+            is_causal=True)
+        field_map["trg_src_attn_bias"] = make_attn_bias(
+            trg_pos, src_pos, trg_slf_attn_pre_softmax_shape,
+            src_slf_attn_pre_softmax_shape, n_head, max_length)
     enc_output = wrap_encoder(
         src_vocab_size,
         max_length,
@@ -1,11 +1,27 @@
 import os
+import bz2
+import cPickle
+import gzip
+import heapq
+import hashlib
+import mmap
+import multiprocessing
+from array import array
 from functools import partial
-from collections import defaultdict
+from operator import itemgetter
+from collections import Counter
+
+import numpy as np
+
+from file_util import file_md5, write_atomically
 
 __all__ = [
     "train",
     "test",
     "get_dict",
+    "build_dicts",
+    "build_length_index",
+    "split_shards",
 ]
 
 DATA_HOME = "./"
@@ -15,48 +31,400 @@ START_MARK = "_GO"
 END_MARK = "_EOS"
 UNK_MARK = "_UNK"
 
+# the word dicts loaded in this process, which are keyed by the dict path.
+_loaded_dicts = {}
+
+# the approximate number of bytes read from the data files at a time.
+READ_CHUNK_SIZE = 1 << 20
+
+# the suffix of the length indexes beside the plain data files.
+LENGTH_INDEX_SUFFIX = ".lenidx.npz"
+
+
+def __open_file(file_path):
+    if file_path.endswith(".gz"):
+        return gzip.open(file_path, "rb")
+    elif file_path.endswith(".bz2"):
+        return bz2.BZ2File(file_path, "r")
+    return open(file_path, "r")
+
+
+def __read_lines(file_path,
+                 start=0,
+                 end=None,
+                 chunk_size=READ_CHUNK_SIZE,
+                 with_position=False):
+    """
+    Stream the lines of a plain, gzip or bz2 compressed (by the suffix .gz or
+    .bz2) file, reading about chunk_size bytes at a time, thus the memory usage
+    and time to the first line are independent of the file size.
+
+    Only the lines starting in the byte range [start, end) are read, where the
+    offsets of compressed files are those of the decompressed data. If
+    with_position is True, each line is yielded with the offset of the next
+    line.
+    """
+    with __open_file(file_path) as f:
+        if start > 0:
+            # Skip the rest of the line which starts before the range.
+            f.seek(start - 1)
+            f.readline()
+        pos = f.tell()
+        while True:
+            lines = f.readlines(chunk_size)
+            if not lines:
+                break
+            for line in lines:
+                if end is not None and pos >= end:
+                    return
+                pos += len(line)
+                yield (pos, line) if with_position else line
+
+
+def __data_files(data_path):
+    return [
+        os.path.join(data_path, f) for f in sorted(os.listdir(data_path))
+        if LENGTH_INDEX_SUFFIX not in f
+    ] if os.path.isdir(data_path) else [data_path]
+
+
+def __is_compressed(file_path):
+    return file_path.endswith(".gz") or file_path.endswith(".bz2")
+
+
+def build_length_index(file_path):
+    """
+    Build the length index of a plain data file if it is missing or stale, and
+    return its path. The index records the byte offsets of all lines and the
+    numbers of Chinese and English words in each line, where the lengths of
+    malformed lines are -1. It is saved beside the data file and validated by
+    the size and mtime of the data file. None is returned for compressed files,
+    which are not indexed, and if the index can not be written, e.g. on a
+    read-only data directory.
+    """
+    if __is_compressed(file_path):
+        return None
+    index_path = file_path + LENGTH_INDEX_SUFFIX
+    stat = os.stat(file_path)
+    file_stat = np.array([stat.st_size, stat.st_mtime], dtype="float64")
+    if os.path.exists(index_path):
+        with np.load(index_path) as index:
+            if np.array_equal(index["stat"], file_stat):
+                return index_path
+    if not os.access(os.path.dirname(index_path) or ".", os.W_OK):
+        return None
+
+    offsets, cn_lens, en_lens = [0], array("i"), array("i")
+    for line in __read_lines(file_path):
+        offsets.append(offsets[-1] + len(line))
+        line_split = line.strip().split("\t")
+        if len(line_split) != 2:
+            cn_lens.append(-1)
+            en_lens.append(-1)
+            continue
+        cn_lens.append(len(line_split[0].split()))
+        en_lens.append(len(line_split[1].split()))
+
+    def __write(path):
+        with open(path, "wb") as f:
+            np.savez(
+                f,
+                stat=file_stat,
+                offsets=np.array(offsets, dtype="int64"),
+                cn_lens=np.frombuffer(cn_lens, dtype="int32"),
+                en_lens=np.frombuffer(en_lens, dtype="int32"))
+
+    try:
+        write_atomically(index_path, __write)
+    except (IOError, OSError) as e:
+        print("Failed to write the length index of %s, which is read "
+              "without the index: %s" % (file_path, e))
+        return None
+    return index_path
+
+
+def __read_indexed_lines(file_path,
+                         index_path,
+                         src_col,
+                         len_filter,
+                         start=0,
+                         end=None,
+                         with_position=False):
+    """
+    Read the lines of a plain data file by its length index. Only the lines
+    starting in the byte range [start, end) and passing len_filter are read,
+    which are sliced from the memory-mapped file by their offsets, thus the
+    filtered lines are never touched. If with_position is True, each line is
+    yielded with the offset of the next line.
+    """
+    with np.load(index_path) as index:
+        offsets = index["offsets"]
+        src_lens, trg_lens = index["cn_lens"], index["en_lens"]
+    if src_col != 0:
+        src_lens, trg_lens = trg_lens, src_lens
+
+    begin_id = np.searchsorted(offsets[:-1], start)
+    end_id = len(src_lens) if end is None else np.searchsorted(offsets[:-1],
+                                                                end)
+    src_lens, trg_lens = src_lens[begin_id:end_id], trg_lens[begin_id:end_id]
+    line_ids = np.nonzero((src_lens >= 0) &
+                          (src_lens + trg_lens < len_filter))[0]
+    if len(line_ids) == 0:
+        return
+
+    line_ids += begin_id
+    with open(file_path, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        for i in line_ids:
+            line = data[offsets[i]:offsets[i + 1]]
+            yield (int(offsets[i + 1]), line) if with_position else line
+    finally:
+        data.close()
+
+
+def __reader_lines(file_path,
+                   src_col,
+                   len_filter,
+                   start=0,
+                   end=None,
+                   with_position=False):
+    """
+    Read the lines of a data file, filtered by the length index for plain
+    files. The compressed files and the files whose index can not be written
+    are streamed without the filtering, which is left to the reader.
+    """
+    index_path = build_length_index(file_path)
+    if index_path is not None:
+        return __read_indexed_lines(file_path, index_path, src_col,
+                                    len_filter, start, end, with_position)
+    return __read_lines(file_path, start, end, with_position=with_position)
+
+
+def split_shards(data_files, shard_num=None, shard_size=None):
+    """
+    Split the data files into shards of (file_path, start, end). Every file is
+    split on its own into shards of shard_size bytes, thus the shards of a file
+    only change with that file. If shard_size is None, it is chosen for about
+    shard_num shards in total. The compressed files are not split.
+    """
+    sizes = [os.path.getsize(file_path) for file_path in data_files]
+    if shard_size is None:
+        shard_size = sum(sizes) // max(shard_num, 1)
+    shard_size = max(shard_size, 1)
+    shards = []
+    for file_path, size in zip(data_files, sizes):
+        if __is_compressed(file_path):
+            shards.append((file_path, 0, None))
+            continue
+        for start in xrange(0, max(size, 1), shard_size):
+            shards.append((file_path, start, min(start + shard_size, size)))
+    return shards
+
+
+def __count_words(shard):
+    """
+    Count the words of both languages in a shard.
+    """
+    cn_count, en_count = Counter(), Counter()
+    for line in __read_lines(*shard):
+        line_split = line.strip().split("\t")
+        if len(line_split) != 2: continue
+        cn_count.update(line_split[0].split())
+        en_count.update(line_split[1].split())
+    return cn_count, en_count
+
+
+def __build_dict(data_file, dict_sizes, save_paths, process_num=None):
+    """
+    Build the dictionaries of the languages in dict_sizes and save_paths, which
+    are both dicts keyed by language, in one pass over the data. Words of the
+    shards are counted in a process pool and the most frequent words are
+    selected from the merged counts by a partial selection.
+    """
+    process_num = process_num or multiprocessing.cpu_count()
+    shards = split_shards(__data_files(data_file), process_num * 4)
+    word_counts = {"cn": Counter(), "en": Counter()}
+    pool = multiprocessing.Pool(process_num)
+    try:
+        for cn_count, en_count in pool.imap(__count_words, shards):
+            word_counts["cn"].update(cn_count)
+            word_counts["en"].update(en_count)
+    finally:
+        pool.terminate()
+
+    for lang, save_path in save_paths.iteritems():
+        with open(save_path, "w") as fout:
+            fout.write("%s\n%s\n%s\n%s\n" % (PAD_MARK, START_MARK, END_MARK,
+                                             UNK_MARK))
+            for word, _ in heapq.nlargest(
+                    max(dict_sizes[lang] - 4, 0),
+                    word_counts[lang].iteritems(),
+                    key=itemgetter(1)):
+                fout.write("%s\n" % word)
+
+
+def __dict_path(dict_size, lang, dict_file=None):
+    dict_file = "%s_%d.dict" % (lang,
+                                dict_size) if dict_file is None else dict_file
+    return os.path.join(DATA_HOME, dict_file)
+
+
+def __load_dict_file(dict_path):
+    """
+    Load the word to id and id to word dicts of a dict file. The loaded dicts
+    are memoized in the process and also serialized into a cache file beside
+    the dict file. Both are validated by the size and mtime of the dict file,
+    and the cache file is still used if only the mtime changes while the md5
+    does not.
+    """
+    stat = os.stat(dict_path)
+    file_stat = (stat.st_size, stat.st_mtime)
+    if dict_path in _loaded_dicts and _loaded_dicts[dict_path][0] == file_stat:
+        return _loaded_dicts[dict_path][1:]
+
+    cache_path = dict_path + ".cache"
+    cache = None
+    if os.path.exists(cache_path):
+        with open(cache_path, "rb") as f:
+            cache = cPickle.load(f)
+        if cache["stat"] != file_stat and (
+                cache["stat"][0] != file_stat[0] or
+                cache["md5"] != file_md5(dict_path)):
+            cache = None
+    if cache is None:
+        word_dict, idx_dict = {}, {}
+        with open(dict_path, "r") as fdict:
+            for idx, line in enumerate(fdict):
+                word_dict[line.strip()] = idx
+                idx_dict[idx] = line.strip()
+        cache = {
+            "md5": file_md5(dict_path),
+            "word_dict": word_dict,
+            "idx_dict": idx_dict
+        }
+    if cache.get("stat") != file_stat:
+        cache["stat"] = file_stat
+
+        def __write(path):
+            with open(path, "wb") as f:
+                cPickle.dump(cache, f, cPickle.HIGHEST_PROTOCOL)
+
+        write_atomically(cache_path, __write)
+
+    _loaded_dicts[dict_path] = (file_stat, cache["word_dict"],
+                                cache["idx_dict"])
+    return cache["word_dict"], cache["idx_dict"]
+
+
+def __dict_is_valid(dict_path, dict_size):
+    return os.path.exists(dict_path) and (
+        len(__load_dict_file(dict_path)[1]) == dict_size)
+
+
+def build_dicts(data_file,
+                src_dict_size,
+                trg_dict_size,
+                src_dict_file=None,
+                trg_dict_file=None):
+    """
+    Build the invalid source and target dictionaries together in one pass over
+    the data.
+    """
+    dict_sizes, save_paths = {}, {}
+    for lang, dict_size, dict_file in [("cn", src_dict_size, src_dict_file),
+                                       ("en", trg_dict_size, trg_dict_file)]:
+        dict_path = __dict_path(dict_size, lang, dict_file)
+        if not __dict_is_valid(dict_path, dict_size):
+            dict_sizes[lang] = dict_size
+            save_paths[lang] = dict_path
+    if save_paths:
+        __build_dict(
+            os.path.join(DATA_HOME, data_file), dict_sizes, save_paths)
 
-def __build_dict(data_file, dict_size, save_path, lang="cn"):
-    word_dict = defaultdict(int)
-    data_files = [os.path.join(data_file, f) for f in os.listdir(data_file)
-                  ] if os.path.isdir(data_file) else [data_file]
 
-    for file_path in data_files:
-        with open(file_path, mode="r") as f:
-            for line in f.readlines():
-                line_split = line.strip().split("\t")
-                if len(line_split) != 2: continue
-                sen = line_split[0] if lang == "cn" else line_split[1]
-                for w in sen.split():
-                    word_dict[w] += 1
+def __load_dict(data_file, dict_size, lang, dict_file=None, reverse=False):
+    dict_path = __dict_path(dict_size, lang, dict_file)
+    data_path = os.path.join(DATA_HOME, data_file)
+    if not __dict_is_valid(dict_path, dict_size):
+        __build_dict(data_path, {lang: dict_size}, {lang: dict_path})
 
-    with open(save_path, "w") as fout:
-        fout.write("%s\n%s\n%s\n%s\n" % (PAD_MARK, START_MARK, END_MARK,
-                                         UNK_MARK))
-        for idx, word in enumerate(
-                sorted(
-                    word_dict.iteritems(), key=lambda x: x[1], reverse=True)):
-            if idx + 4 == dict_size: break
-            fout.write("%s\n" % (word[0]))
+    word_dict, idx_dict = __load_dict_file(dict_path)
+    return idx_dict if reverse else word_dict
 
 
-def __load_dict(data_file, dict_size, lang, dict_file=None, reverse=False):
-    dict_file = "%s_%d.dict" % (lang,
-                                dict_size) if dict_file is None else dict_file
-    dict_path = os.path.join(DATA_HOME, dict_file)
-    data_path = os.path.join(DATA_HOME, data_file)
-    if not os.path.exists(dict_path) or (
-            len(open(dict_path, "r").readlines()) != dict_size):
-        __build_dict(data_path, dict_size, dict_path, lang)
-
-    word_dict = {}
-    with open(dict_path, "r") as fdict:
-        for idx, line in enumerate(fdict):
-            if reverse:
-                word_dict[idx] = line.strip()
-            else:
-                word_dict[line.strip()] = idx
-    return word_dict
+def __file_signature(file_path):
+    stat = os.stat(file_path)
+    return "%s:%d:%d" % (os.path.abspath(file_path), stat.st_size,
+                         int(stat.st_mtime))
+
+
+def __build_corpus_cache(data_files, src_col, src_dict, trg_dict, unk_id,
+                         cache_path):
+    """
+    Convert the corpus into flat int32 word id arrays and int64 offsets of the
+    source and target sentences, and save them as .npy files into cache_path.
+    The start and end marks are not included.
+    """
+    trg_col = 1 - src_col
+    src_ids, trg_ids = array("i"), array("i")
+    src_offsets, trg_offsets = [0], [0]
+    for file_path in data_files:
+        for line in __read_lines(file_path):
+            line_split = line.strip().split("\t")
+            if len(line_split) != 2:
+                continue
+            src_ids.extend(
+                src_dict.get(w, unk_id) for w in line_split[src_col].split())
+            trg_ids.extend(
+                trg_dict.get(w, unk_id) for w in line_split[trg_col].split())
+            src_offsets.append(len(src_ids))
+            trg_offsets.append(len(trg_ids))
+
+    def __write(path):
+        os.makedirs(path)
+        np.save(
+            os.path.join(path, "src_ids.npy"),
+            np.frombuffer(src_ids, dtype="int32"))
+        np.save(
+            os.path.join(path, "trg_ids.npy"),
+            np.frombuffer(trg_ids, dtype="int32"))
+        np.save(
+            os.path.join(path, "src_offsets.npy"),
+            np.array(src_offsets, dtype="int64"))
+        np.save(
+            os.path.join(path, "trg_offsets.npy"),
+            np.array(trg_offsets, dtype="int64"))
+
+    # Write into a temporary directory first, thus an interrupted conversion
+    # never leaves a cache that looks valid.
+    try:
+        write_atomically(cache_path, __write)
+    except OSError:
+        # The cache can not be renamed onto the one built by another process
+        # meanwhile, which is used instead.
+        if not os.path.exists(cache_path):
+            raise
+
+
+def __load_corpus_cache(data_files, dict_paths, src_col, src_dict, trg_dict,
+                        unk_id, cache_dir):
+    """
+    Memory-map the pre-tokenized corpus, which is converted once and keyed by
+    the signatures (path, size and mtime) of the data files and dict files.
+    """
+    key = hashlib.md5("\n".join(
+        [str(src_col)] + [__file_signature(path)
+                          for path in data_files + dict_paths])).hexdigest()
+    cache_path = os.path.join(cache_dir, "corpus_%s" % key)
+    if not os.path.exists(cache_path):
+        __build_corpus_cache(data_files, src_col, src_dict, trg_dict, unk_id,
+                             cache_path)
+    return [
+        np.load(
+            os.path.join(cache_path, name + ".npy"), mmap_mode="r")
+        for name in ["src_ids", "src_offsets", "trg_ids", "trg_offsets"]
+    ]
 
 
 def reader_creator(data_file,
@@ -65,8 +433,25 @@ def reader_creator(data_file,
                    trg_dict_size,
                    src_dict_file=None,
                    trg_dict_file=None,
-                   len_filter=200):
-    def reader():
+                   len_filter=200,
+                   cache_dir=None,
+                   positioned=False):
+    """
+    Create the reader yielding (source ids, target ids, next target ids). If
+    cache_dir is set, the corpus is tokenized only once into a binary cache
+    under cache_dir and the reader yields from the memory-mapped cache.
+    Otherwise, plain files are read through their length indexes.
+
+    If positioned is True, the reader takes an optional position to start
+    from and yields (position, instance), where the position of an instance
+    is where the reading resumes after it. A position is [file index, byte
+    offset], or [0, instance index] when reading from the cache.
+    """
+    def reader(position=None):
+        file_id, offset = position or (0, 0)
+
+        build_dicts(data_file, src_dict_size, trg_dict_size, src_dict_file,
+                    trg_dict_file)
         src_dict = __load_dict(data_file, src_dict_size, "cn", src_dict_file)
         trg_dict = __load_dict(data_file, trg_dict_size, "en", trg_dict_file)
 
@@ -81,27 +466,49 @@ def reader_creator(data_file,
         trg_col = 1 - src_col
 
         data_path = os.path.join(DATA_HOME, data_file)
-        data_files = [
-            os.path.join(data_path, f) for f in os.listdir(data_path)
-        ] if os.path.isdir(data_path) else [data_path]
-        for file_path in data_files:
-            with open(file_path, mode="r") as f:
-                for line in f.readlines():
-                    line_split = line.strip().split("\t")
-                    if len(line_split) != 2:
-                        continue
-                    src_words = line_split[src_col].split()
-                    src_ids = [start_id] + [
-                        src_dict.get(w, unk_id) for w in src_words
-                    ] + [end_id]
-
-                    trg_words = line_split[trg_col].split()
-                    trg_ids = [trg_dict.get(w, unk_id) for w in trg_words]
-
-                    trg_ids_next = trg_ids + [end_id]
-                    trg_ids = [start_id] + trg_ids
-                    if len(src_words) + len(trg_words) < len_filter:
-                        yield src_ids, trg_ids, trg_ids_next
+        data_files = __data_files(data_path)
+        if cache_dir is not None:
+            src_ids, src_offsets, trg_ids, trg_offsets = __load_corpus_cache(
+                data_files, [
+                    __dict_path(src_dict_size, "cn", src_dict_file),
+                    __dict_path(trg_dict_size, "en", trg_dict_file)
+                ], src_col, src_dict, trg_dict, unk_id, cache_dir)
+            lens = np.diff(src_offsets) + np.diff(trg_offsets)
+            for i in np.nonzero(lens < len_filter)[0]:
+                if i < offset:
+                    continue
+                src_words = src_ids[src_offsets[i]:src_offsets[i + 1]]
+                trg_words = trg_ids[trg_offsets[i]:trg_offsets[i + 1]]
+                src_inst = [start_id] + src_words.tolist() + [end_id]
+                trg_inst = trg_words.tolist()
+                inst = src_inst, [start_id] + trg_inst, trg_inst + [end_id]
+                yield ([0, int(i) + 1], inst) if positioned else inst
+            return
+
+        for file_id in xrange(file_id, len(data_files)):
+            for next_offset, line in __reader_lines(
+                    data_files[file_id],
+                    src_col,
+                    len_filter,
+                    offset,
+                    with_position=True):
+                line_split = line.strip().split("\t")
+                if len(line_split) != 2:
+                    continue
+                src_words = line_split[src_col].split()
+                src_ids = [start_id] + [
+                    src_dict.get(w, unk_id) for w in src_words
+                ] + [end_id]
+
+                trg_words = line_split[trg_col].split()
+                trg_ids = [trg_dict.get(w, unk_id) for w in trg_words]
+
+                trg_ids_next = trg_ids + [end_id]
+                trg_ids = [start_id] + trg_ids
+                if len(src_words) + len(trg_words) < len_filter:
+                    inst = src_ids, trg_ids, trg_ids_next
+                    yield ([file_id, next_offset], inst) if positioned else inst
+            offset = 0
 
     return reader
 
@@ -110,7 +517,15 @@ def reader_creator_with_file(data_file,
                              src_lang,
                              src_dict,
                              trg_dict,
-                             len_filter=200):
+                             len_filter=200,
+                             start=0,
+                             end=None):
+    """
+    Create the reader of a data file with the loaded dictionaries. For plain
+    files, only the lines starting in the byte range [start, end) are read
+    through the length index.
+    """
+
     def reader():
         # the indice for start mark, end mark, and unk are the same in source
         # language and target language. Here uses the source language
@@ -122,23 +537,23 @@ def reader_creator_with_file(data_file,
         src_col = 0 if src_lang == "cn" else 1
         trg_col = 1 - src_col
 
-        with open(data_file, mode="r") as f:
-            for line in f.readlines():
-                line_split = line.strip().split("\t")
-                if len(line_split) != 2:
-                    continue
-                src_words = line_split[src_col].split()
-                src_ids = [start_id
-                           ] + [src_dict.get(w, unk_id)
-                                for w in src_words] + [end_id]
+        for line in __reader_lines(data_file, src_col, len_filter, start,
+                                   end):
+            line_split = line.strip().split("\t")
+            if len(line_split) != 2:
+                continue
+            src_words = line_split[src_col].split()
+            src_ids = [start_id] + [
+                src_dict.get(w, unk_id) for w in src_words
+            ] + [end_id]
 
-                trg_words = line_split[trg_col].split()
-                trg_ids = [trg_dict.get(w, unk_id) for w in trg_words]
+            trg_words = line_split[trg_col].split()
+            trg_ids = [trg_dict.get(w, unk_id) for w in trg_words]
 
-                trg_ids_next = trg_ids + [end_id]
-                trg_ids = [start_id] + trg_ids
-                if len(src_words) + len(trg_words) < len_filter:
-                    yield src_ids, trg_ids, trg_ids_next
+            trg_ids_next = trg_ids + [end_id]
+            trg_ids = [start_id] + trg_ids
+            if len(src_words) + len(trg_words) < len_filter:
+                yield src_ids, trg_ids, trg_ids_next
 
     return reader
 
@@ -149,9 +564,19 @@ def train(data_file,
           src_lang="cn",
           src_dict_file=None,
           trg_dict_file=None,
-          len_filter=200):
-    return reader_creator(data_file, src_lang, src_dict_size, trg_dict_size,
-                          src_dict_file, trg_dict_file, len_filter)
+          len_filter=200,
+          cache_dir=None,
+          positioned=False):
+    return reader_creator(
+        data_file,
+        src_lang,
+        src_dict_size,
+        trg_dict_size,
+        src_dict_file,
+        trg_dict_file,
+        len_filter,
+        cache_dir,
+        positioned=positioned)
 
 
 def train_creators(data_dir,
@@ -161,9 +586,11 @@ def train_creators(data_dir,
                    src_dict_file=None,
                    trg_dict_file=None,
                    len_filter=200):
+    build_dicts(data_dir, src_dict_size, trg_dict_size, src_dict_file,
+                trg_dict_file)
     src_dict = __load_dict(data_dir, src_dict_size, "cn", src_dict_file)
     trg_dict = __load_dict(data_dir, trg_dict_size, "en", trg_dict_file)
-    data_files = [os.path.join(data_dir, f) for f in os.listdir(data_dir)]
+    data_files = __data_files(data_dir)
 
     return [{
         "data_file": filename,
@@ -178,8 +605,6 @@ test = partial(train, len_filter=100000)
 
 
 def get_dict(data_file, dict_size, lang, dict_file=None, reverse=False):
-    dict_file = "%s_%d.dict" % (lang,
-                                dict_size) if dict_file is None else dict_file
-    dict_path = os.path.join(DATA_HOME, dict_file)
+    dict_path = __dict_path(dict_size, lang, dict_file)
     assert os.path.exists(dict_path), "Word dictionary does not exist. "
     return __load_dict(data_file, dict_size, lang, dict_file, reverse)
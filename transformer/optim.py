@@ -1,3 +1,4 @@
+import math
 import numpy as np
 
 import paddle.fluid as fluid
@@ -6,35 +7,165 @@ import paddle.fluid.layers as layers
 
 class LearningRateScheduler(object):
     """
-    Wrapper for learning rate scheduling as described in the Transformer paper.
-    LearningRateScheduler adapts the learning rate externally and the adapted
-    learning rate will be feeded into the main_program as input data.
+    Learning rate scheduling computed inside the program. The learning rate is
+    computed from a persistable global step counter, which is increased by
+    every run of the program creating the scheduler, thus nothing is fed per
+    step and the counter is saved and restored in checkpoints along with the
+    optimizer states. The scheduler should be created in the program running
+    the optimizer, so that the steps are counted by updates.
+
+    The schedules include "noam" as described in the Transformer paper, which
+    increases linearly in warmup_steps and then decreases by the inverse square
+    root of steps, and "linear" and "cosine", which increase linearly to
+    learning_rate in warmup_steps and then decay to 0 at total_steps linearly
+    or along a cosine curve.
     """
 
+    SCHEDULES = ("noam", "linear", "cosine")
+    # the number of terms of the Taylor series computing the cosine decay,
+    # which is accurate to float32 precision.
+    COSINE_TERM_NUM = 8
+
     def __init__(self,
                  d_model,
                  warmup_steps,
-                 place,
                  learning_rate=0.001,
-                 current_steps=0,
-                 name="learning_rate"):
-        self.current_steps = current_steps
-        self.warmup_steps = warmup_steps
+                 schedule="noam",
+                 total_steps=100000,
+                 counter_name="@LR_STEP_COUNTER@"):
+        if schedule not in self.SCHEDULES:
+            raise ValueError(
+                "Unknown learning rate schedule: %s, which should be one of "
+                "%s." % (schedule, ", ".join(self.SCHEDULES)))
         self.d_model = d_model
-        self.learning_rate = layers.create_global_var(
-            name=name,
-            shape=[1],
-            value=float(learning_rate),
-            dtype="float32",
-            persistable=True)
-        self.place = place
-
-    def update_learning_rate(self, data_input):
-        self.current_steps += 1
-        lr_value = np.power(self.d_model, -0.5) * np.min([
-            np.power(self.current_steps, -0.5),
-            np.power(self.warmup_steps, -1.5) * self.current_steps
-        ])
-        lr_tensor = fluid.LoDTensor()
-        lr_tensor.set(np.array([lr_value], dtype="float32"), self.place)
-        data_input[self.learning_rate.name] = lr_tensor
+        self.warmup_steps = warmup_steps
+        self.base_learning_rate = learning_rate
+        self.total_steps = total_steps
+        self.global_step = layers.autoincreased_step_counter(
+            counter_name=counter_name, begin=1)
+        step = layers.cast(self.global_step, "float32")
+        if schedule == "noam":
+            self.learning_rate = self.__noam(step)
+        elif schedule == "linear":
+            self.learning_rate = self.__linear(step)
+        else:
+            self.learning_rate = self.__cosine(step)
+
+    def __constant(self, value):
+        return layers.fill_constant(shape=[1], dtype="float32", value=value)
+
+    def __noam(self, step):
+        lr = layers.elementwise_min(
+            layers.pow(step, factor=-0.5),
+            layers.scale(step, scale=self.warmup_steps**-1.5))
+        return layers.scale(lr, scale=self.d_model**-0.5)
+
+    def __warmup(self, step):
+        return layers.elementwise_min(
+            layers.scale(step, scale=1. / self.warmup_steps),
+            self.__constant(1.))
+
+    def __linear(self, step):
+        decay = layers.relu(step * (-1. / self.total_steps) + 1.)
+        return layers.scale(
+            self.__warmup(step) * decay, scale=self.base_learning_rate)
+
+    def __cosine(self, step):
+        """
+        The decay (1 + cos(pi * t)) / 2 for t = step / total_steps in [0, 1]
+        equals (1 - sin(x)) / 2 for x = pi * (t - 1 / 2), whose sine is
+        computed by the Taylor series on [-pi / 2, pi / 2] with the basic ops,
+        since there is no cosine op in the fluid version in use.
+        """
+        step = layers.elementwise_min(step,
+                                      self.__constant(float(self.total_steps)))
+        x = step * (np.pi / self.total_steps) - np.pi / 2
+        x_square = x * x
+        sin = self.__constant(
+            (-1.)**(self.COSINE_TERM_NUM - 1) /
+            math.factorial(2 * self.COSINE_TERM_NUM - 1))
+        for i in reversed(xrange(self.COSINE_TERM_NUM - 1)):
+            sin = sin * x_square + (-1.)**i / math.factorial(2 * i + 1)
+        decay = (x * sin) * -0.5 + 0.5
+        return layers.scale(
+            self.__warmup(step) * decay, scale=self.base_learning_rate)
+
+
+class GradientAccumulator(object):
+    """
+    Accumulate the gradients over micro-batches and update the parameters once
+    by the accumulated gradients, which makes large effective batches possible
+    under limited memory.
+
+    The ops appended to the program of loss add the gradients of loss into
+    persistable accumulators, together with the number of tokens. The
+    optimizer is applied in the separate update_program, which averages the
+    accumulated gradients over the accumulated tokens if normalize is True and
+    then resets the accumulators. Thus the program of loss is run for every
+    micro-batch and update_program for every update.
+    """
+
+    def __init__(self, loss, token_num, normalize=True):
+        self.normalize = normalize
+        self.update_program = fluid.Program()
+        params_grads = fluid.backward.append_backward(loss)
+        with fluid.program_guard(loss.block.program):
+            self.token_num = layers.create_global_var(
+                name=token_num.name + "@ACC",
+                shape=[1],
+                value=0.,
+                dtype="float32",
+                persistable=True)
+            layers.sums(input=[self.token_num, token_num], out=self.token_num)
+            self.params_accs = []
+            for param, grad in params_grads:
+                if not param.trainable or grad is None:
+                    continue
+                acc = layers.create_global_var(
+                    name=param.name + "@ACC",
+                    shape=param.shape,
+                    value=0.,
+                    dtype=param.dtype,
+                    persistable=True)
+                layers.sums(input=[acc, grad], out=acc)
+                self.params_accs.append((param, acc))
+
+    def apply_optimizer(self, optimizer):
+        """
+        Append the ops updating the parameters by optimizer with the
+        accumulated gradients, and resetting the accumulators, to
+        update_program. The optimizer and its learning rate should be created
+        under the program guard of update_program.
+        """
+        block = self.update_program.global_block()
+        with fluid.program_guard(self.update_program):
+            # Declare the variables shared with the program of loss in
+            # update_program, which are found in the same scope when running.
+            token_num = block.create_var(
+                name=self.token_num.name,
+                shape=self.token_num.shape,
+                dtype=self.token_num.dtype,
+                persistable=True)
+            params_grads, accs = [], []
+            for param, acc in self.params_accs:
+                param = block.create_parameter(
+                    name=param.name,
+                    shape=param.shape,
+                    dtype=param.dtype,
+                    trainable=param.trainable,
+                    optimize_attr=param.optimize_attr,
+                    regularizer=param.regularizer,
+                    gradient_clip_attr=param.gradient_clip_attr)
+                acc = block.create_var(
+                    name=acc.name,
+                    shape=acc.shape,
+                    dtype=acc.dtype,
+                    persistable=True)
+                grad = layers.elementwise_div(
+                    acc, token_num) if self.normalize else acc
+                params_grads.append((param, grad))
+                accs.append(acc)
+            optimizer.create_optimization_pass(params_grads, token_num)
+            for acc in accs + [token_num]:
+                layers.fill_constant(
+                    shape=acc.shape, dtype=acc.dtype, value=0., out=acc)
@@ -1,7 +1,11 @@
 import argparse
 import distutils.util
+import json
+import time
+from array import array
 import numpy as np
-import re
+
+from config import TrainTaskConfig
 
 
 def print_arguments(args):
@@ -17,27 +21,30 @@ def log_info(s):
     except:
         raise argparse.ArgumentTypeError('Format of log info '
                                          'should be "log_file:log_label".')
+    return log_file, log_label
 
 
 parser = argparse.ArgumentParser("Tools to plot learning curves.")
 parser.add_argument(
     '--log_infos',
-    type=str,
+    type=log_info,
     nargs='+',
     required=True,
     help='Log infos to indicate whose curves to plot. '
-    'Format is "log_file:log_label".')
+    'Format is "log_file:log_label". The log file is either the training '
+    'output or the JSON lines metrics file.')
 parser.add_argument(
     '--plot_item',
     type=str,
-    choices=['sum loss', 'avg loss', 'ppl'],
-    default='ppl',
-    help='Item to plot. (default: %(default)d)')
+    nargs='+',
+    choices=['sum loss', 'avg loss', 'ppl', 'tokens/sec', 'step time'],
+    default=['ppl'],
+    help='Items to plot, each into a subplot. (default: %(default)s)')
 parser.add_argument(
     '--save_path',
     type=str,
     default='./curve_comparison.png',
-    help='Path to save plotting image. (default: %(default)d)')
+    help='Path to save plotting image. (default: %(default)s)')
 parser.add_argument(
     '--plot_validation',
     type=distutils.util.strtobool,
@@ -48,6 +55,29 @@ parser.add_argument(
     type=distutils.util.strtobool,
     default=True,
     help='Whether show the image. (default: %(default)d)')
+parser.add_argument(
+    '--log_interval',
+    type=int,
+    default=TrainTaskConfig.metrics_interval,
+    help='Number of steps between two training lines, which gives the steps '
+    'of the lines in the logs without steps. (default: %(default)d)')
+parser.add_argument(
+    '--max_points',
+    type=int,
+    default=4000,
+    help='Max number of points of a curve, beyond which the curve is '
+    'downsampled keeping the extrema. (default: %(default)d)')
+parser.add_argument(
+    '--follow',
+    action='store_true',
+    help='Keep reading the lines appended to the logs and redrawing, '
+    'like "tail -f".')
+parser.add_argument(
+    '--refresh_interval',
+    type=float,
+    default=10.,
+    help='Seconds between two redraws in follow mode. '
+    '(default: %(default)s)')
 args = parser.parse_args()
 
 import matplotlib
@@ -63,66 +93,147 @@ def item_to_name(item):
         return 'AVG Loss'
     elif item == 'ppl':
         return 'PPL'
-
-
-def parse_log(log_file, item):
-    iter_num = 0
-    train_item = []
-    val_item = []
-    iter_num = 0
-    train_pattern = r'.*, %s: ([^,]+),.*' % item
-    val_pattern = r'.*, %s: ([^,]+),.*' % ('val ' + item)
-    for line in open(log_file):
-        line = line.strip()
-        line += ','
-        train_matched = re.match(train_pattern, line)
-        val_matched = re.match(val_pattern, line)
-        if train_matched is not None:
-            train_item.append([iter_num, float(train_matched.groups()[0])])
-            iter_num += 1
-        elif val_matched is not None:
-            val_item.append([iter_num, float(val_matched.groups()[0])])
-
-    return np.array(train_item), np.array(val_item)
-
-
-fig = plt.figure(figsize=(8, 6))
-ax = fig.add_subplot(111)
-
-whether_plot_val = False
-
-for log_info in args.log_infos:
-    log_file, log_label = log_info.split(':')
-    train_item, val_item = parse_log(log_file, args.plot_item)
-
-    if args.plot_validation and len(val_item) > 0:
-        whether_plot_val = True
-
-    plt.plot(
-        train_item[:, 0],
-        train_item[:, 1],
-        label=log_label + '-' + item_to_name(args.plot_item),
-        linewidth=0.5)
-
-    if whether_plot_val:
-        plt.plot(
-            val_item[:, 0],
-            val_item[:, 1],
-            label=log_label + '-' + 'Val ' + item_to_name(args.plot_item),
-            linewidth=1.0,
-            linestyle='-.')
-
-colormap = plt.cm.gist_ncar  #nipy_spectral, Set1,Paired
-
-colors = np.linspace(0.1, 0.8, len(ax.lines))
-colors = [colormap(i) for i in colors]
-
-for i, j in enumerate(ax.lines):
-    j.set_color(colors[i])
-
-ax.legend(loc='best')
-ax.set_xlabel('Iteration Number', fontsize=10)
-ax.set_ylabel(item_to_name(args.plot_item), fontsize=10)
-plt.savefig(args.save_path, bbox_inches='tight')
-if args.whether_show:
+    return item.capitalize()
+
+
+def parse_line(line):
+    """
+    Parse a line of the JSON lines metrics file or of the training output,
+    whose items are in the format of "name: value" separated by ", ".
+    """
+    if line.startswith('{'):
+        try:
+            return json.loads(line)
+        except ValueError:
+            return {}
+    record = {}
+    for field in line.split(', '):
+        name, sep, value = field.partition(': ')
+        if sep:
+            try:
+                record[name.strip()] = float(value)
+            except ValueError:
+                continue
+    return record
+
+
+class LogParser(object):
+    """
+    Parse a log in a single streaming pass, extracting the training and
+    validation curves of all the items. The points are the steps and item
+    values. The lines without steps, which are written by older versions,
+    take the steps by counting the training lines every log_interval steps.
+    Calling parse() again reads only the lines appended since the last call,
+    which are complete.
+    """
+
+    def __init__(self, log_file, items, log_interval=1):
+        self.log_file = log_file
+        self.items = items
+        self.log_interval = log_interval
+        self.offset = 0
+        self.iter_num = 0
+        self.curves = {}
+        for item in items:
+            for name in [item, 'val ' + item]:
+                self.curves[name] = (array('d'), array('d'))
+
+    def parse(self):
+        with open(self.log_file, 'r') as f:
+            f.seek(self.offset)
+            for line in f:
+                if not line.endswith('\n'):
+                    break  # The line is being written.
+                self.offset += len(line)
+                record = parse_line(line.strip())
+                if not record:
+                    continue
+                train_found = any(item in record for item in self.items)
+                x = record.get('step', (self.iter_num + train_found) *
+                               self.log_interval)
+                for name, (xs, ys) in self.curves.iteritems():
+                    if isinstance(record.get(name), (int, float)):
+                        xs.append(x)
+                        ys.append(record[name])
+                if train_found:
+                    self.iter_num += 1
+
+    def curve(self, name):
+        xs, ys = self.curves[name]
+        return np.frombuffer(xs), np.frombuffer(ys)
+
+
+def downsample(xs, ys, max_points):
+    """
+    Downsample a curve to about max_points points by splitting it into
+    max_points / 2 buckets and keeping the minimum and the maximum of each
+    bucket in their order, thus the spikes are preserved.
+    """
+    if max_points <= 0 or len(xs) <= max_points:
+        return xs, ys
+    bucket_num = max(max_points // 2, 1)
+    bounds = np.linspace(0, len(xs), bucket_num + 1).astype('int64')
+    indices = []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        if start == end:
+            continue
+        bucket = ys[start:end]
+        indices.extend(
+            sorted(set([start + np.argmin(bucket),
+                        start + np.argmax(bucket)])))
+    return xs[indices], ys[indices]
+
+
+def plot(fig, log_parsers):
+    fig.clf()
+    for item_id, item in enumerate(args.plot_item):
+        ax = fig.add_subplot(len(args.plot_item), 1, item_id + 1)
+        for log_parser, log_label in log_parsers:
+            xs, ys = downsample(*(log_parser.curve(item) +
+                                  (args.max_points, )))
+            if len(xs) > 0:
+                ax.plot(
+                    xs,
+                    ys,
+                    label=log_label + '-' + item_to_name(item),
+                    linewidth=0.5)
+            xs, ys = downsample(*(log_parser.curve('val ' + item) +
+                                  (args.max_points, )))
+            if args.plot_validation and len(xs) > 0:
+                ax.plot(
+                    xs,
+                    ys,
+                    label=log_label + '-' + 'Val ' + item_to_name(item),
+                    linewidth=1.0,
+                    linestyle='-.')
+
+        colormap = plt.cm.gist_ncar  #nipy_spectral, Set1,Paired
+
+        colors = np.linspace(0.1, 0.8, len(ax.lines))
+        colors = [colormap(i) for i in colors]
+
+        for i, j in enumerate(ax.lines):
+            j.set_color(colors[i])
+
+        if ax.lines:
+            ax.legend(loc='best')
+        ax.set_xlabel('Step', fontsize=10)
+        ax.set_ylabel(item_to_name(item), fontsize=10)
+    plt.savefig(args.save_path, bbox_inches='tight')
+
+
+log_parsers = [(LogParser(log_file, args.plot_item, args.log_interval),
+                log_label) for log_file, log_label in args.log_infos]
+fig = plt.figure(figsize=(8, 6 * len(args.plot_item)))
+while True:
+    for log_parser, log_label in log_parsers:
+        log_parser.parse()
+    plot(fig, log_parsers)
+    if not args.follow:
+        break
+    if args.whether_show:
+        plt.pause(args.refresh_interval)
+    else:
+        time.sleep(args.refresh_interval)
+if args.whether_show and not args.follow:
     plt.show()
@@ -1,143 +1,144 @@
 import cPickle
-import numpy as np
+import hashlib
+import json
 import os
+import time
+import shutil
+from functools import partial
 
-import paddle  # .v2 as paddle
 import paddle.fluid as fluid
 
 import nist_data_provider
-from config import TrainTaskConfig, ModelHyperParams, encoder_input_data_names, decoder_input_data_names, \
-    label_data_names
+from config import TrainTaskConfig, ModelHyperParams
 from recordio_helper import FieldHelper
+from file_util import file_md5, write_atomically
+from data_util import BatchStats, train_batch_reader, prepare_batch_input
 import multiprocessing
 
+# The version of the content of recordio files, which is bumped to rebuild the
+# files written by older versions.
+RECORDIO_VERSION = 2
+# The byte size of the chunks the data files are split into for converting.
+# Every file is chunked on its own, thus a changed file only changes its own
+# chunks.
+CHUNK_SIZE = 16 << 20
 
-def pad_batch_data(insts,
-                   pad_idx,
-                   n_head,
-                   is_target=False,
-                   return_pos=True,
-                   return_attn_bias=True,
-                   return_max_len=True):
+
+def __dict_md5(word_dict):
+    return hashlib.md5("\n".join(
+        word for word, idx in sorted(
+            word_dict.iteritems(), key=lambda x: x[1]))).hexdigest()
+
+
+def __concat_files(filenames, path):
+    with open(path, "wb") as fout:
+        for filename in filenames:
+            with open(filename, "rb") as fin:
+                shutil.copyfileobj(fin, fout, 1 << 20)
+
+
+def __chunk_keys(chunks, field_helper, manifest):
     """
-    Pad the instances to the max sequence length in batch, and generate the
-    corresponding position data and attention bias.
+    Compute the keys of the chunks, which are the hashes of the content of the
+    source shard and the byte range, the dictionaries and the configs affecting
+    the conversion. The content hashes of shards are reused from the manifest
+    if the size and mtime of shards are unchanged.
     """
-    return_list = []
-    max_len = max(len(inst) for inst in insts)
-    inst_data = np.array(
-        [inst + [pad_idx] * (max_len - len(inst)) for inst in insts])
-    return_list += [inst_data.astype("int64").reshape([-1, 1])]
-    if return_pos:
-        inst_pos = np.array([[
-            pos_i + 1 if w_i != pad_idx else 0
-            for pos_i, w_i in enumerate(inst)
-        ] for inst in inst_data])
-
-        return_list += [inst_pos.astype("int64").reshape([-1, 1])]
-    if return_attn_bias:
-        if is_target:
-            # This is used to avoid attention on paddings and subsequent
-            # words.
-            slf_attn_bias_data = np.ones(
-                (inst_data.shape[0], max_len, max_len))
-            slf_attn_bias_data = np.triu(slf_attn_bias_data,
-                                         1).reshape([-1, 1, max_len, max_len])
-            slf_attn_bias_data = np.tile(slf_attn_bias_data,
-                                         [1, n_head, 1, 1]) * [-1e9]
-        else:
-            # This is used to avoid attention on paddings.
-            slf_attn_bias_data = np.array([[0] * len(inst) + [-1e9] *
-                                           (max_len - len(inst))
-                                           for inst in insts])
-            slf_attn_bias_data = np.tile(
-                slf_attn_bias_data.reshape([-1, 1, 1, max_len]),
-                [1, n_head, max_len, 1])
-        return_list += [slf_attn_bias_data.astype("float32")]
-    if return_max_len:
-        return_list += [max_len]
-    return return_list if len(return_list) > 1 else return_list[0]
-
-
-def prepare_batch_input(insts, input_data_names, src_pad_idx, trg_pad_idx,
-                        n_head, d_model):
+    config_key = repr((RECORDIO_VERSION, field_helper.layout,
+                       TrainTaskConfig.batch_size,
+                       TrainTaskConfig.use_token_batch,
+                       TrainTaskConfig.max_tokens, TrainTaskConfig.pool_size,
+                       ModelHyperParams.n_head, ModelHyperParams.d_model,
+                       ModelHyperParams.src_pad_idx,
+                       ModelHyperParams.trg_pad_idx))
+    dict_keys = {}
+    shards = manifest.setdefault("shards", {})
+    chunk_keys = []
+    for creator in chunks:
+        file_path = creator["data_file"]
+        stat = os.stat(file_path)
+        shard = shards.get(file_path)
+        if shard is None or shard["size"] != stat.st_size or shard[
+                "mtime"] != stat.st_mtime:
+            shard = shards[file_path] = {
+                "size": stat.st_size,
+                "mtime": stat.st_mtime,
+                "md5": file_md5(file_path)
+            }
+        for lang in ["src_dict", "trg_dict"]:
+            if id(creator[lang]) not in dict_keys:
+                dict_keys[id(creator[lang])] = __dict_md5(creator[lang])
+        chunk_keys.append(
+            hashlib.md5("\n".join([
+                config_key, shard["md5"], dict_keys[id(creator["src_dict"])],
+                dict_keys[id(creator["trg_dict"])], creator["src_lang"],
+                str(creator["len_filter"]), str(creator["start"]),
+                str(creator["end"])
+            ])).hexdigest())
+    return chunk_keys
+
+
+def __assign_parts(chunks, part_num):
     """
-    Put all padded data needed by training into a dict.
+    Assign the chunks to part_num parts. The consecutive chunks of a file go
+    to the consecutive parts from a part chosen by the hash of the file path,
+    thus the parts have balanced sizes, and a chunk stays in the same part
+    across runs regardless of the other chunks and files. The chunks in a part
+    keep their original order.
     """
-    src_word, src_pos, src_slf_attn_bias, src_max_len = pad_batch_data(
-        [inst[0] for inst in insts], src_pad_idx, n_head, is_target=False)
-    trg_word, trg_pos, trg_slf_attn_bias, trg_max_len = pad_batch_data(
-        [inst[1] for inst in insts], trg_pad_idx, n_head, is_target=True)
-    trg_src_attn_bias = np.tile(src_slf_attn_bias[:, :, ::src_max_len, :],
-                                [1, 1, trg_max_len, 1]).astype("float32")
-
-    # These shape tensors are used in reshape_op.
-    src_data_shape = np.array(
-        [len(insts), src_max_len, d_model], dtype="int32")
-    trg_data_shape = np.array(
-        [len(insts), trg_max_len, d_model], dtype="int32")
-    src_slf_attn_pre_softmax_shape = np.array(
-        [-1, src_slf_attn_bias.shape[-1]], dtype="int32")
-    src_slf_attn_post_softmax_shape = np.array(
-        src_slf_attn_bias.shape, dtype="int32")
-    trg_slf_attn_pre_softmax_shape = np.array(
-        [-1, trg_slf_attn_bias.shape[-1]], dtype="int32")
-    trg_slf_attn_post_softmax_shape = np.array(
-        trg_slf_attn_bias.shape, dtype="int32")
-    trg_src_attn_pre_softmax_shape = np.array(
-        [-1, trg_src_attn_bias.shape[-1]], dtype="int32")
-    trg_src_attn_post_softmax_shape = np.array(
-        trg_src_attn_bias.shape, dtype="int32")
-
-    lbl_word = pad_batch_data([inst[2] for inst in insts], trg_pad_idx, n_head,
-                              False, False, False, False)
-    lbl_weight = (lbl_word != trg_pad_idx).astype("float32").reshape([-1, 1])
-
-    input_dict = dict(
-        zip(input_data_names, [
-            src_word, src_pos, src_slf_attn_bias, src_data_shape,
-            src_slf_attn_pre_softmax_shape, src_slf_attn_post_softmax_shape,
-            trg_word, trg_pos, trg_slf_attn_bias, trg_src_attn_bias,
-            trg_data_shape, trg_slf_attn_pre_softmax_shape,
-            trg_slf_attn_post_softmax_shape, trg_src_attn_pre_softmax_shape,
-            trg_src_attn_post_softmax_shape, lbl_word, lbl_weight
-        ]))
-    return input_dict
+    part_chunks = [[] for i in xrange(part_num)]
+    for chunk_id, chunk in enumerate(chunks):
+        first_part_id = int(
+            hashlib.md5(chunk["data_file"]).hexdigest()[:8], 16)
+        part_id = (first_part_id + chunk["start"] // CHUNK_SIZE) % part_num
+        part_chunks[part_id].append(chunk_id)
+    return part_chunks
 
 
 def create_recordio_file(item):
-    filename, reader_creator, i, field_helper = item
+    filename, reader_creator, field_helper = item
     reader_creator = nist_data_provider.reader_creator_with_file(
         **reader_creator)
 
-    train_data = paddle.batch(
-        reader_creator, batch_size=TrainTaskConfig.batch_size)
-    with fluid.recordio_writer.create_recordio_writer(
-            filename, max_num_records=100) as writer:
-        for j, batch in enumerate(train_data()):
-            if len(batch) != TrainTaskConfig.batch_size:
-                continue
-            data_input = prepare_batch_input(
-                batch, encoder_input_data_names + decoder_input_data_names[:-1]
-                + label_data_names, ModelHyperParams.src_pad_idx,
-                ModelHyperParams.trg_pad_idx, ModelHyperParams.n_head,
-                ModelHyperParams.d_model)
-
-            for input_name in encoder_input_data_names + decoder_input_data_names[:
-                                                                                  -1] + label_data_names:
-                if input_name not in data_input:
-                    continue
-                tensor = data_input[input_name]
-                t = fluid.LoDTensor()
-                t.set(tensor, fluid.CPUPlace())
-                if i == 0 and j == 0:
-                    field_helper.append_field(input_name, tensor.dtype)
-                writer.append_tensor(t)
-            writer.complete_append_tensor()
-    return field_helper
-
+    train_data = train_batch_reader(reader_creator, shuffle=False)
+    input_data_names = field_helper.input_data_names()
+    batch_stats = BatchStats()
+
+    def __write(path):
+        with fluid.recordio_writer.create_recordio_writer(
+                path, max_num_records=100) as writer:
+            # Every record holds the shapes of its own mini-batch, thus the
+            # tail batches and the batches packed by a token budget are kept.
+            for batch in train_data():
+                batch_stats.update(batch)
+                data_input = prepare_batch_input(
+                    batch, input_data_names, ModelHyperParams.src_pad_idx,
+                    ModelHyperParams.trg_pad_idx, ModelHyperParams.n_head,
+                    ModelHyperParams.d_model)
+                field_helper.check_record(data_input)
+
+                for input_name in input_data_names:
+                    t = fluid.LoDTensor()
+                    t.set(data_input[input_name], fluid.CPUPlace())
+                    writer.append_tensor(t)
+                writer.complete_append_tensor()
+
+    write_atomically(filename, __write)
+    print("%s %s" % (filename, batch_stats.report()))
+    return filename
+
+
+def create_or_get_data(process_num=10, single_file=False, part_num=None):
+    """
+    Convert the training data into part_num recordio files.
 
-def create_or_get_data(process_num=10, single_file=False):
+    The data files are split into chunks of CHUNK_SIZE bytes, which are
+    converted by a process pool with dynamic scheduling and then concatenated
+    into parts with balanced sizes. A manifest records the key of each part,
+    thus only the parts whose source data, dictionaries or batching configs
+    changed are rebuilt.
+    """
+    part_num = part_num or TrainTaskConfig.recordio_part_num
     creators = nist_data_provider.train_creators(
         "data", ModelHyperParams.src_vocab_size,
         ModelHyperParams.trg_vocab_size)
@@ -145,32 +146,97 @@ def create_or_get_data(process_num=10, single_file=False):
     if single_file:
         creators = creators[:1]  # drop other files. Make test faster
 
+    creator_map = dict((creator["data_file"], creator) for creator in creators)
+    chunks, chunk_sizes = [], []
+    for file_path, start, end in nist_data_provider.split_shards(
+            sorted(creator_map.keys()), shard_size=CHUNK_SIZE):
+        chunks.append(dict(creator_map[file_path], start=start, end=end))
+        chunk_sizes.append((end if end is not None else
+                            os.path.getsize(file_path)) - start)
+    # The parts without chunks are left out, and the others keep their names
+    # by their indices.
+    part_ids, part_chunks = zip(*[(part_id, chunk_ids)
+                                  for part_id, chunk_ids in enumerate(
+                                      __assign_parts(chunks, part_num))
+                                  if chunk_ids])
+
     recordio_files = [
         "./nist06_batchsize_{0}.part{1}.recordio".format(
-            TrainTaskConfig.batch_size, i) for i in xrange(len(creators))
+            TrainTaskConfig.batch_size, part_id) for part_id in part_ids
     ]
     field_helpers_fn = './nist06_batchsize_{0}.recordio.fields'.format(
         TrainTaskConfig.batch_size)
-    any_file_not_exist = reduce(
-        lambda acc, path: acc or not os.path.exists(path),
-        [field_helpers_fn] + recordio_files, False)
-    if any_file_not_exist:
-        pool = multiprocessing.Pool(process_num)
-        field_helper = FieldHelper(recordio_files)
-
-        items = []
-        for i, pair in enumerate(zip(recordio_files, creators)):
-            items.append((pair[0], pair[1], i, field_helper))
-
-        field_helper = pool.map(create_recordio_file, items)[0]
-        #create_recordio_file(items[0])
-
-        with open(field_helpers_fn, 'w') as f:
+    manifest_fn = './nist06_batchsize_{0}.recordio.manifest'.format(
+        TrainTaskConfig.batch_size)
+    field_helper = FieldHelper(recordio_files,
+                               TrainTaskConfig.recordio_layout)
+
+    manifest = {}
+    if os.path.exists(manifest_fn):
+        with open(manifest_fn, 'r') as f:
+            manifest = json.load(f)
+    chunk_keys = __chunk_keys(chunks, field_helper, manifest)
+    parts = manifest.setdefault("parts", {})
+
+    def __write_manifest(path):
+        with open(path, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+
+    items, part_keys, remaining_chunks = [], {}, {}
+    total_size = 0
+    for filename, chunk_ids in zip(recordio_files, part_chunks):
+        part_keys[filename] = hashlib.md5("\n".join(
+            chunk_keys[chunk_id] for chunk_id in chunk_ids)).hexdigest()
+        if parts.get(filename) == part_keys[filename] and os.path.exists(
+                filename):
+            continue
+        remaining_chunks[filename] = len(chunk_ids)
+        for chunk_id in chunk_ids:
+            items.append(("%s.chunk%d" % (filename, chunk_id),
+                          chunks[chunk_id], field_helper))
+            total_size += chunk_sizes[chunk_id]
+
+    if items:
+        done_size = 0
+        start_time = time.time()
+        pool = multiprocessing.Pool(min(process_num, len(items)))
+        try:
+            # Build the length indexes of the data files once before the
+            # chunks of the same file read them.
+            pool.map(nist_data_provider.build_length_index,
+                     sorted(set(item[1]["data_file"] for item in items)))
+            for chunk_fn in pool.imap_unordered(create_recordio_file, items):
+                filename, done_chunk_id = chunk_fn.rsplit(".chunk", 1)
+                done_size += chunk_sizes[int(done_chunk_id)]
+                elapsed_time = time.time() - start_time
+                print("converted %.1f/%.1f MB, %.2f MB/s" %
+                      (done_size / 1e6, total_size / 1e6,
+                       done_size / 1e6 / max(elapsed_time, 1e-6)))
+                remaining_chunks[filename] -= 1
+                if remaining_chunks[filename] > 0:
+                    continue
+                # Recordio files consist of independent chunks, thus the part
+                # is assembled by concatenating the files of its chunks.
+                chunk_fns = [
+                    "%s.chunk%d" % (filename, part_chunk_id)
+                    for part_chunk_id in part_chunks[recordio_files.index(
+                        filename)]
+                ]
+                write_atomically(filename,
+                                   partial(__concat_files, chunk_fns))
+                for fn in chunk_fns:
+                    os.remove(fn)
+                parts[filename] = part_keys[filename]
+                write_atomically(manifest_fn, __write_manifest)
+        finally:
+            pool.terminate()
+
+    def __write_fields(path):
+        with open(path, 'w') as f:
             cPickle.dump(field_helper, f, cPickle.HIGHEST_PROTOCOL)
-        return field_helper
-    else:
-        with open(field_helpers_fn, 'r') as f:
-            return cPickle.load(f)
+
+    write_atomically(field_helpers_fn, __write_fields)
+    return field_helper
 
 
 if __name__ == "__main__":
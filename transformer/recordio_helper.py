@@ -1,29 +1,123 @@
+import random
+
 import paddle.fluid as fluid
-from config import data_shapes
+from config import data_shapes, data_dtypes, encoder_input_data_names, \
+    decoder_input_data_names, label_data_names, attn_bias_data_names, \
+    ModelHyperParams
 
 
 class FieldHelper(object):
-    def __init__(self, filenames):
+    # The layouts of the recordio files. The "full" layout stores all the data
+    # fed to the model, while the "compact" layout leaves out the dense
+    # attention biases, which are rebuilt inside the program after reading.
+    LAYOUTS = ("full", "compact")
+    # The layout of the field helpers pickled before layouts were introduced.
+    layout = "full"
+
+    def __init__(self, filenames, layout="full"):
+        if layout not in self.LAYOUTS:
+            raise ValueError("Unknown recordio layout: %s." % layout)
         self.fields = []
         self.dtypes = []
+        self.shapes = []
         self.filenames = filenames
+        self.layout = layout
+        for field_name in self.input_data_names():
+            self.append_field(field_name, data_dtypes[field_name],
+                              data_shapes[field_name])
+
+    def input_data_names(self):
+        """
+        The names of the data stored in the recordio files of this layout.
+        """
+        input_data_names = encoder_input_data_names + \
+            decoder_input_data_names[:-1] + label_data_names
+        if self.layout == "compact":
+            input_data_names = tuple(name for name in input_data_names
+                                     if name not in attn_bias_data_names)
+        return input_data_names
 
-    def append_field(self, field_name, dtype):
-        print 'Append Shape', field_name, dtype
+    def append_field(self, field_name, dtype, shape):
+        print 'Append Shape', field_name, dtype, shape
         self.fields.append(field_name)
         self.dtypes.append(dtype)
+        self.shapes.append(shape)
 
-    def create_reader(self, use_open_files=False):
+    def field_shapes(self):
+        """
+        The shapes of the fields, in which the batch size and sequence lengths
+        varying among records are -1. The field helpers pickled before shapes
+        were recorded take the shapes from the config.
+        """
+        return getattr(self, "shapes", None) or [
+            data_shapes[field] for field in self.fields
+        ]
+
+    def placeholder_shapes(self):
+        """
+        The shapes to declare the fields in the program. The shapes only need
+        to pass the shape inference at compile time, since the actual shapes
+        are set by every record read at run time. Thus the batch size is
+        replaced by 1 and the sequence lengths by max_length + 1, and the
+        leading dimension of rank-2 fields is batch_size * max_len_in_batch.
+        """
+        max_len = ModelHyperParams.max_length + 1
         shapes = []
+        for shape in self.field_shapes():
+            shape = list(shape)
+            for i, dim in enumerate(shape):
+                if dim == -1:
+                    shape[i] = 1 if i == 0 and len(shape) > 2 else max_len
+            shapes.append(tuple(shape))
+        return shapes
+
+    def check_record(self, data_input):
+        """
+        Check the data of a record against the dtypes and the shapes of the
+        fields, where the dimensions of -1 can take any size.
+        """
+        for field, dtype, shape in zip(self.fields, self.dtypes,
+                                       self.field_shapes()):
+            data = data_input[field]
+            if data.dtype != dtype:
+                raise ValueError("The dtype of %s is %s, but %s is expected." %
+                                 (field, data.dtype, dtype))
+            if len(data.shape) != len(shape) or any(
+                    dim != -1 and dim != actual_dim
+                    for dim, actual_dim in zip(shape, data.shape)):
+                raise ValueError("The shape of %s is %s, which mismatches %s." %
+                                 (field, data.shape, shape))
 
-        for field in self.fields:
-            shapes.append(data_shapes[field])
+    def create_reader(self,
+                      use_open_files=False,
+                      thread_num=1,
+                      pass_num=1,
+                      shuffle_files=False,
+                      shuffle_buffer_size=0,
+                      seed=None):
+        """
+        Create the reader of the recordio files. If use_open_files is True,
+        all the files are read by thread_num threads for pass_num passes, and
+        the order of files is reshuffled in every pass if shuffle_files is
+        True. Otherwise, only the first file is read. If shuffle_buffer_size is
+        larger than 0, the mini-batches are shuffled in a buffer of that size.
+        """
+        shapes = self.placeholder_shapes()
         if use_open_files:
+            # The files of all passes are listed in one reader, thus the order
+            # of files can differ among passes.
+            filenames = []
+            rand = random.Random(seed)
+            for pass_id in xrange(pass_num):
+                pass_filenames = list(self.filenames)
+                if shuffle_files:
+                    rand.shuffle(pass_filenames)
+                filenames += pass_filenames
             file_obj = fluid.layers.open_files(
-                filenames=[self.filenames[0]],
+                filenames=filenames,
                 dtypes=self.dtypes,
                 shapes=shapes,
-                thread_num=1,
+                thread_num=thread_num,
                 lod_levels=[0] * len(shapes))
 
         else:
@@ -33,6 +127,10 @@ class FieldHelper(object):
                 shapes=shapes,
                 lod_levels=[0] * len(shapes))
 
+        if shuffle_buffer_size > 0:
+            file_obj = fluid.layers.shuffle(
+                file_obj, buffer_size=shuffle_buffer_size)
+
         vars = fluid.layers.read_file(file_obj)
 
         result = dict()
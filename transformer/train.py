@@ -1,111 +1,33 @@
 import os
 import time
+import argparse
 import numpy as np
 
 import paddle
 import paddle.fluid as fluid
 
 from model import transformer, position_encoding_init
-from optim import LearningRateScheduler
+from optim import LearningRateScheduler, GradientAccumulator
 from config import TrainTaskConfig, ModelHyperParams, pos_enc_param_names, \
-        encoder_input_data_names, decoder_input_data_names, label_data_names
+        encoder_input_data_names, decoder_input_data_names, label_data_names, \
+        attn_bias_data_names
 import nist_data_provider
+from data_util import BatchStats, Prefetcher, MultiProcessPrefetcher, \
+        ResumableReader, prepare_batch_input, train_batch_reader
+from checkpoint import CheckpointManager
+from metrics import TrainMetrics, Instrumentation
 
-
-def pad_batch_data(insts,
-                   pad_idx,
-                   n_head,
-                   is_target=False,
-                   return_pos=True,
-                   return_attn_bias=True,
-                   return_max_len=True):
-    """
-    Pad the instances to the max sequence length in batch, and generate the
-    corresponding position data and attention bias.
-    """
-    return_list = []
-    max_len = max(len(inst) for inst in insts)
-    inst_data = np.array(
-        [inst + [pad_idx] * (max_len - len(inst)) for inst in insts])
-    return_list += [inst_data.astype("int64").reshape([-1, 1])]
-    if return_pos:
-        inst_pos = np.array([[
-            pos_i + 1 if w_i != pad_idx else 0
-            for pos_i, w_i in enumerate(inst)
-        ] for inst in inst_data])
-
-        return_list += [inst_pos.astype("int64").reshape([-1, 1])]
-    if return_attn_bias:
-        if is_target:
-            # This is used to avoid attention on paddings and subsequent
-            # words.
-            slf_attn_bias_data = np.ones(
-                (inst_data.shape[0], max_len, max_len))
-            slf_attn_bias_data = np.triu(slf_attn_bias_data,
-                                         1).reshape([-1, 1, max_len, max_len])
-            slf_attn_bias_data = np.tile(slf_attn_bias_data,
-                                         [1, n_head, 1, 1]) * [-1e9]
-        else:
-            # This is used to avoid attention on paddings.
-            slf_attn_bias_data = np.array([[0] * len(inst) + [-1e9] *
-                                           (max_len - len(inst))
-                                           for inst in insts])
-            slf_attn_bias_data = np.tile(
-                slf_attn_bias_data.reshape([-1, 1, 1, max_len]),
-                [1, n_head, max_len, 1])
-        return_list += [slf_attn_bias_data.astype("float32")]
-    if return_max_len:
-        return_list += [max_len]
-    return return_list if len(return_list) > 1 else return_list[0]
-
-
-def prepare_batch_input(insts, input_data_names, src_pad_idx, trg_pad_idx,
-                        n_head, d_model):
-    """
-    Put all padded data needed by training into a dict.
-    """
-    src_word, src_pos, src_slf_attn_bias, src_max_len = pad_batch_data(
-        [inst[0] for inst in insts], src_pad_idx, n_head, is_target=False)
-    trg_word, trg_pos, trg_slf_attn_bias, trg_max_len = pad_batch_data(
-        [inst[1] for inst in insts], trg_pad_idx, n_head, is_target=True)
-    trg_src_attn_bias = np.tile(src_slf_attn_bias[:, :, ::src_max_len, :],
-                                [1, 1, trg_max_len, 1]).astype("float32")
-
-    # These shape tensors are used in reshape_op.
-    src_data_shape = np.array(
-        [len(insts), src_max_len, d_model], dtype="int32")
-    trg_data_shape = np.array(
-        [len(insts), trg_max_len, d_model], dtype="int32")
-    src_slf_attn_pre_softmax_shape = np.array(
-        [-1, src_slf_attn_bias.shape[-1]], dtype="int32")
-    src_slf_attn_post_softmax_shape = np.array(
-        src_slf_attn_bias.shape, dtype="int32")
-    trg_slf_attn_pre_softmax_shape = np.array(
-        [-1, trg_slf_attn_bias.shape[-1]], dtype="int32")
-    trg_slf_attn_post_softmax_shape = np.array(
-        trg_slf_attn_bias.shape, dtype="int32")
-    trg_src_attn_pre_softmax_shape = np.array(
-        [-1, trg_src_attn_bias.shape[-1]], dtype="int32")
-    trg_src_attn_post_softmax_shape = np.array(
-        trg_src_attn_bias.shape, dtype="int32")
-
-    lbl_word = pad_batch_data([inst[2] for inst in insts], trg_pad_idx, n_head,
-                              False, False, False, False)
-    lbl_weight = (lbl_word != trg_pad_idx).astype("float32").reshape([-1, 1])
-
-    input_dict = dict(
-        zip(input_data_names, [
-            src_word, src_pos, src_slf_attn_bias, src_data_shape,
-            src_slf_attn_pre_softmax_shape, src_slf_attn_post_softmax_shape,
-            trg_word, trg_pos, trg_slf_attn_bias, trg_src_attn_bias,
-            trg_data_shape, trg_slf_attn_pre_softmax_shape,
-            trg_slf_attn_post_softmax_shape, trg_src_attn_pre_softmax_shape,
-            trg_src_attn_post_softmax_shape, lbl_word, lbl_weight
-        ]))
-    return input_dict
+parser = argparse.ArgumentParser("Training for Transformer.")
+parser.add_argument(
+    '--resume',
+    action='store_true',
+    default=TrainTaskConfig.resume,
+    help='Resume from the latest checkpoint in model_dir. '
+    '(default: %(default)s)')
 
 
 def main():
+    args = parser.parse_args()
     place = fluid.CUDAPlace(0) if TrainTaskConfig.use_gpu else fluid.CPUPlace()
     exe = fluid.Executor(place)
 
@@ -116,24 +38,128 @@ def main():
         ModelHyperParams.d_key, ModelHyperParams.d_value,
         ModelHyperParams.d_model, ModelHyperParams.d_inner_hid,
         ModelHyperParams.dropout, ModelHyperParams.src_pad_idx,
-        ModelHyperParams.trg_pad_idx, ModelHyperParams.pos_pad_idx)
-
-    lr_scheduler = LearningRateScheduler(ModelHyperParams.d_model,
-                                         TrainTaskConfig.warmup_steps, place,
-                                         TrainTaskConfig.learning_rate)
-    optimizer = fluid.optimizer.Adam(
-        learning_rate=lr_scheduler.learning_rate,
-        beta1=TrainTaskConfig.beta1,
-        beta2=TrainTaskConfig.beta2,
-        epsilon=TrainTaskConfig.eps)
-    optimizer.minimize(avg_cost if TrainTaskConfig.use_avg_cost else sum_cost)
-
-    train_data = paddle.batch(
-        paddle.reader.shuffle(
-            nist_data_provider.train("data", ModelHyperParams.src_vocab_size,
-                                     ModelHyperParams.trg_vocab_size),
-            buf_size=100000),
-        batch_size=TrainTaskConfig.batch_size)
+        ModelHyperParams.trg_pad_idx, ModelHyperParams.pos_pad_idx,
+        TrainTaskConfig.attn_bias_in_graph)
+
+    train_program = fluid.framework.default_main_program()
+    # Clone the program for validation before any op of training is appended,
+    # and prune it into the inference mode.
+    val_program = fluid.io.get_inference_program(
+        [sum_cost, token_num], train_program.clone())
+    # The parameters are updated in train_program by every mini-batch, or in
+    # the update program of accumulator by every accum_steps mini-batches.
+    update_program = train_program
+    accumulator = None
+    if TrainTaskConfig.accum_steps > 1:
+        # Accumulate the gradients of the sum loss, which are averaged over
+        # the tokens of all the accumulated mini-batches for the average loss.
+        accumulator = GradientAccumulator(sum_cost, token_num,
+                                          TrainTaskConfig.use_avg_cost)
+        update_program = accumulator.update_program
+    with fluid.program_guard(update_program):
+        # The learning rate is scheduled by the runs of update_program.
+        lr_scheduler = LearningRateScheduler(
+            ModelHyperParams.d_model, TrainTaskConfig.warmup_steps,
+            TrainTaskConfig.learning_rate, TrainTaskConfig.lr_schedule,
+            TrainTaskConfig.lr_total_steps)
+        optimizer = fluid.optimizer.Adam(
+            learning_rate=lr_scheduler.learning_rate,
+            beta1=TrainTaskConfig.beta1,
+            beta2=TrainTaskConfig.beta2,
+            epsilon=TrainTaskConfig.eps)
+        if accumulator is not None:
+            accumulator.apply_optimizer(optimizer)
+        else:
+            optimizer.minimize(avg_cost if TrainTaskConfig.use_avg_cost else
+                               sum_cost)
+
+    # The loss and tokens are accumulated inside train_program and only
+    # fetched every metrics_interval steps.
+    metrics = TrainMetrics(sum_cost, token_num,
+                           TrainTaskConfig.metrics_interval)
+    # The per-phase timers written into metrics_file, which do nothing if no
+    # metrics_file is set.
+    instrumentation = Instrumentation(TrainTaskConfig.metrics_file,
+                                      TrainTaskConfig.metrics_interval)
+
+    data_reader = ResumableReader(
+        nist_data_provider.train(
+            "data",
+            ModelHyperParams.src_vocab_size,
+            ModelHyperParams.trg_vocab_size,
+            cache_dir=TrainTaskConfig.data_cache_dir,
+            positioned=True),
+        shuffle=True)
+    train_data = data_reader
+    batch_stats = BatchStats()
+
+    input_data_names = encoder_input_data_names + \
+        decoder_input_data_names[:-1] + label_data_names
+    if TrainTaskConfig.attn_bias_in_graph:
+        input_data_names = filter(
+            lambda name: name not in attn_bias_data_names, input_data_names)
+
+    def __prepare(data):
+        # Only the counts of the mini-batch are returned with the feed dict,
+        # thus the raw mini-batch is not sent back by the worker processes.
+        return BatchStats.counts(data), prepare_batch_input(
+            data, input_data_names, ModelHyperParams.src_pad_idx,
+            ModelHyperParams.trg_pad_idx, ModelHyperParams.n_head,
+            ModelHyperParams.d_model)
+
+    def __load_val_data():
+        # Build the dicts from the training data before reading the held-out
+        # data, which shares the dicts.
+        nist_data_provider.build_dicts("data",
+                                       ModelHyperParams.src_vocab_size,
+                                       ModelHyperParams.trg_vocab_size)
+        val_reader = train_batch_reader(
+            nist_data_provider.test(TrainTaskConfig.val_data,
+                                    ModelHyperParams.src_vocab_size,
+                                    ModelHyperParams.trg_vocab_size),
+            shuffle=False)
+        return [__prepare(data)[1] for data in val_reader()]
+
+    val_data = __load_val_data() if (TrainTaskConfig.val_data is not None and
+                                     TrainTaskConfig.val_freq > 0) else None
+
+    def __validate():
+        total_sum_cost, total_token_num = 0., 0.
+        for data_input in val_data:
+            sum_cost_val, token_num_val = exe.run(
+                val_program,
+                feed=data_input,
+                fetch_list=[sum_cost, token_num],
+                use_program_cache=True)
+            total_sum_cost += float(np.sum(sum_cost_val))
+            total_token_num += float(np.sum(token_num_val))
+        val_avg_cost = total_sum_cost / max(total_token_num, 1.)
+        return val_avg_cost, float(np.exp(min(val_avg_cost, 100)))
+
+    prefetch_thread_num = TrainTaskConfig.prefetch_thread_num
+    prefetch_ordered = TrainTaskConfig.prefetch_ordered
+    if (TrainTaskConfig.checkpoint_freq > 0 or args.resume) and (
+            prefetch_thread_num > 1 or not prefetch_ordered):
+        # The position of the data saved in the checkpoints inside passes
+        # counts the consumed mini-batches, which only marks the consumed data
+        # if the mini-batches are consumed in the order of the reader.
+        print("checkpoints need the mini-batches in order, thus "
+              "prefetch_thread_num is set to 1 and prefetch_ordered to True")
+        prefetch_thread_num = 1
+        prefetch_ordered = True
+    # The prefetched mini-batches are prepared by other threads or processes
+    # and timed separately, while preparing synchronously is part of reading.
+    __timed_prepare = instrumentation.timed_fn(__prepare, "prepare")
+    if TrainTaskConfig.prefetch_process_num > 0:
+        train_data = MultiProcessPrefetcher(
+            train_data, __timed_prepare, TrainTaskConfig.prefetch_process_num,
+            TrainTaskConfig.prefetch_depth, prefetch_ordered)
+    elif TrainTaskConfig.prefetch_depth > 0:
+        train_data = Prefetcher(train_data, __timed_prepare,
+                                TrainTaskConfig.prefetch_depth,
+                                prefetch_thread_num)
+    else:
+        train_data = paddle.reader.map_readers(__prepare, train_data)
 
     # Initialize the parameters.
     exe.run(fluid.framework.default_startup_program())
@@ -144,32 +170,109 @@ def main():
             position_encoding_init(ModelHyperParams.max_length + 1,
                                    ModelHyperParams.d_model), place)
 
-    for pass_id in xrange(TrainTaskConfig.pass_num):
-        pass_start_time = time.time()
-        for batch_id, data in enumerate(train_data()):
-            data_input = prepare_batch_input(
-                data, encoder_input_data_names + decoder_input_data_names[:-1]
-                + label_data_names, ModelHyperParams.src_pad_idx,
-                ModelHyperParams.trg_pad_idx, ModelHyperParams.n_head,
-                ModelHyperParams.d_model)
-            lr_scheduler.update_learning_rate(data_input)
-            outs = exe.run(fluid.framework.default_main_program(),
-                           feed=data_input,
-                           fetch_list=[sum_cost, avg_cost],
-                           use_program_cache=True)
-            sum_cost_val, avg_cost_val = np.array(outs[0]), np.array(outs[1])
-            print("epoch: %d, batch: %d, sum loss: %f, avg loss: %f, ppl: %f" %
-                  (pass_id, batch_id, sum_cost_val, avg_cost_val,
-                   np.exp([min(avg_cost_val[0], 100)])))
-        pass_end_time = time.time()
-        time_consumed = pass_end_time - pass_start_time
-        print("pass_id = " + str(pass_id) + " time_consumed = " + str(
-            time_consumed))
-        fluid.io.save_inference_model(
-            os.path.join(TrainTaskConfig.model_dir,
-                         "pass_" + str(pass_id) + ".infer.model"),
-            encoder_input_data_names + decoder_input_data_names[:-1],
-            [predict], exe)
+    # The checkpoints hold the optimizer states, the steps of the learning
+    # rate scheduler and the position of the training data, from which a
+    # resumed run continues without re-reading the consumed data.
+    checkpoints = CheckpointManager(
+        os.path.join(TrainTaskConfig.model_dir, "checkpoints"),
+        TrainTaskConfig.checkpoint_keep_num,
+        TrainTaskConfig.checkpoint_max_pending)
+    step = 0
+    if args.resume:
+        state = checkpoints.load(exe, [train_program, update_program])
+        if state is not None:
+            step = state["step"]
+            data_reader.set_state(state["data_state"])
+            print("resumed from step %d" % step)
+    metrics.reset(step)
+
+    def __save_checkpoint(data_state):
+        checkpoints.save(exe, step, {"data_state": data_state},
+                         [train_program, update_program])
+
+    # The pending checkpoints are written even if the training fails.
+    try:
+        for pass_id in xrange(data_reader.state()["epoch"],
+                              TrainTaskConfig.pass_num):
+            pass_start_time = time.time()
+            batch_stats.reset()
+            # The batches consumed before resuming are skipped by the reader.
+            start_batch_id = data_reader.state()["batch_id"]
+            for batch_id, (batch_counts, data_input) in enumerate(
+                    instrumentation.timed(train_data(), "read"),
+                    start_batch_id):
+                batch_stats.add(batch_counts)
+                step += 1
+                fetch_metrics = metrics.should_fetch(step)
+                fetch_list = metrics.fetch_list() if fetch_metrics else []
+                if instrumentation.enabled:
+                    # Copy the feed into tensors and fetch the tensors, thus
+                    # the feeding and fetching are timed apart from running.
+                    with instrumentation.phase("feed"):
+                        for name, value in data_input.iteritems():
+                            tensor = fluid.LoDTensor()
+                            tensor.set(value, place)
+                            data_input[name] = tensor
+                    with instrumentation.phase("run"):
+                        outs = exe.run(train_program,
+                                       feed=data_input,
+                                       fetch_list=fetch_list,
+                                       use_program_cache=True,
+                                       return_numpy=False)
+                    with instrumentation.phase("fetch"):
+                        outs = [np.array(out) for out in outs]
+                else:
+                    outs = exe.run(train_program,
+                                   feed=data_input,
+                                   fetch_list=fetch_list,
+                                   use_program_cache=True)
+                if accumulator is not None and (
+                        step % TrainTaskConfig.accum_steps == 0):
+                    with instrumentation.phase("update"):
+                        exe.run(update_program,
+                                fetch_list=[],
+                                use_program_cache=True)
+                if TrainTaskConfig.checkpoint_freq > 0 and (
+                        step % TrainTaskConfig.checkpoint_freq == 0):
+                    with instrumentation.phase("checkpoint"):
+                        __save_checkpoint(data_reader.state(batch_id + 1))
+                metric_values = {}
+                if fetch_metrics:
+                    metric_values = metrics.compute(step, outs)
+                    print("epoch: %d, batch: %d, step: %d, %s" %
+                          (pass_id, batch_id, step,
+                           metrics.report(step, outs, metric_values)))
+                instrumentation.step(
+                    step, batch_counts, epoch=pass_id, **metric_values)
+                if val_data is not None and (
+                        step % TrainTaskConfig.val_freq == 0):
+                    with instrumentation.phase("validate"):
+                        val_avg_cost, val_ppl = __validate()
+                    print("epoch: %d, batch: %d, step: %d, val avg loss: %f, "
+                          "val ppl: %f" %
+                          (pass_id, batch_id, step, val_avg_cost, val_ppl))
+                    instrumentation.log(
+                        step, **{"val avg loss": val_avg_cost,
+                                 "val ppl": val_ppl})
+            pass_end_time = time.time()
+            time_consumed = pass_end_time - pass_start_time
+            print("pass_id = " + str(pass_id) + " time_consumed = " + str(
+                time_consumed))
+            print("pass_id = " + str(pass_id) + " " + batch_stats.report())
+            if hasattr(train_data, "wait_time"):
+                print("pass_id = %d queue wait time = %f, waits = %d" %
+                      (pass_id, train_data.wait_time, train_data.wait_count))
+            if getattr(train_data, "pickled_num", 0) > 0:
+                print("pass_id = %d pickled results = %d" %
+                      (pass_id, train_data.pickled_num))
+            fluid.io.save_inference_model(
+                os.path.join(TrainTaskConfig.model_dir,
+                             "pass_" + str(pass_id) + ".infer.model"),
+                input_data_names[:-len(label_data_names)], [predict], exe)
+            __save_checkpoint(data_reader.state())
+    finally:
+        checkpoints.close()
+        instrumentation.close()
 
 
 if __name__ == "__main__":
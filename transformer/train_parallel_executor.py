@@ -1,18 +1,43 @@
+import os
 import paddle.fluid as fluid
 from prepare_data import create_or_get_data
 from config import ModelHyperParams, TrainTaskConfig
 from model import transformer_pe
+from optim import LearningRateScheduler
+from metrics import TrainMetrics, Instrumentation
 import sys
 import numpy
 
+# The message of the error raised by the reader ops of the recordio files when
+# all the passes are read.
+READER_EOF_MESSAGE = "There is no next data"
+
+
+def is_reader_eof(e):
+    """
+    Whether the error raised by running the program marks the end of the
+    data rather than a failure, e.g. out of memory or mismatched data.
+    """
+    return READER_EOF_MESSAGE in str(e)
+
 
 def main():
+    if not TrainTaskConfig.use_gpu and TrainTaskConfig.cpu_num > 0:
+        # ParallelExecutor creates a replica on every CPU place of CPU_NUM.
+        os.environ['CPU_NUM'] = str(TrainTaskConfig.cpu_num)
+    place = fluid.CUDAPlace(0) if TrainTaskConfig.use_gpu else fluid.CPUPlace()
+
     startup = fluid.Program()
     main = fluid.Program()
-    multi_files = False
+    multi_files = True
     field_helper = create_or_get_data(single_file=not multi_files)
     with fluid.program_guard(main, startup):
-        fileds = field_helper.create_reader(use_open_files=multi_files)
+        fileds = field_helper.create_reader(
+            use_open_files=multi_files,
+            thread_num=TrainTaskConfig.reader_thread_num,
+            pass_num=TrainTaskConfig.pass_num,
+            shuffle_files=True,
+            shuffle_buffer_size=TrainTaskConfig.reader_shuffle_buffer_size)
 
         sum_cost, avg_cost, predict, token_num = transformer_pe(
             fileds, ModelHyperParams.src_vocab_size + 0,
@@ -24,26 +49,65 @@ def main():
             ModelHyperParams.src_pad_idx, ModelHyperParams.trg_pad_idx,
             ModelHyperParams.pos_pad_idx)
 
+        # The learning rate is computed inside the program, since nothing is
+        # fed in the recordio path.
+        lr_scheduler = LearningRateScheduler(
+            ModelHyperParams.d_model, TrainTaskConfig.warmup_steps,
+            TrainTaskConfig.learning_rate, TrainTaskConfig.lr_schedule,
+            TrainTaskConfig.lr_total_steps)
         optimizer = fluid.optimizer.Adam(
-            learning_rate=1e-3,
+            learning_rate=lr_scheduler.learning_rate,
             beta1=TrainTaskConfig.beta1,
             beta2=TrainTaskConfig.beta2,
             epsilon=TrainTaskConfig.eps)
 
         optimizer.minimize(sum_cost)
 
-        exe = fluid.Executor(fluid.CUDAPlace(0))
+        # The batch sizes are counted by the first elements of the data
+        # shapes accumulated with the loss and tokens.
+        metrics = TrainMetrics(sum_cost, token_num,
+                               TrainTaskConfig.metrics_interval,
+                               fileds["trg_data_shape"])
+
+        exe = fluid.Executor(place)
         exe.run(startup)
 
-        exe = fluid.ParallelExecutor(loss_name=sum_cost.name, use_cuda=True)
+        exe = fluid.ParallelExecutor(
+            loss_name=sum_cost.name,
+            use_cuda=TrainTaskConfig.use_gpu,
+            num_threads=TrainTaskConfig.num_threads or None)
+        print 'Training on {0} {1} replicas'.format(
+            exe.device_count, 'GPU' if TrainTaskConfig.use_gpu else 'CPU')
 
+        # The data is read inside the program, thus only running and
+        # fetching are timed.
+        instrumentation = Instrumentation(TrainTaskConfig.metrics_file,
+                                          TrainTaskConfig.metrics_interval)
+        metrics.reset()
+        fetch_list = [total.name for total in metrics.fetch_list()]
         for i in xrange(sys.maxint):
-            if i % 10 == 0:
-                cost_np = map(numpy.array,
-                              exe.run(fetch_list=[sum_cost.name]))[0]
-                print 'Batch {0}, Cost {1}'.format(i, cost_np[0])
-            else:
-                exe.run(fetch_list=[])
+            try:
+                metric_values = {}
+                if metrics.should_fetch(i + 1):
+                    with instrumentation.phase("run"):
+                        outs = exe.run(fetch_list=fetch_list)
+                    with instrumentation.phase("fetch"):
+                        outs = [numpy.array(out) for out in outs]
+                    metric_values = metrics.compute(i + 1, outs)
+                    print 'Batch {0}, step: {1}, {2}'.format(
+                        i, i + 1, metrics.report(i + 1, outs, metric_values))
+                else:
+                    with instrumentation.phase("run"):
+                        exe.run(fetch_list=[])
+                instrumentation.step(i + 1, **metric_values)
+            except fluid.core.EnforceNotMet as e:
+                if not is_reader_eof(e):
+                    raise
+                # The reader is exhausted after all the passes.
+                print 'Finished after {0} batches on {1} replicas'.format(
+                    i, exe.device_count)
+                break
+        instrumentation.close()
 
 
 if __name__ == '__main__':